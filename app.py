@@ -1,7 +1,7 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, send_file
 import cv2
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageFile, GifImagePlugin
 import requests
 import io
 import pytesseract
@@ -12,149 +12,2311 @@ import logging
 import os
 import uuid
 import base64
+import time
+import threading
+from collections import OrderedDict
+import json
+import hashlib
+import sqlite3
+import bisect
+import math
+import mmap
+import itertools
+import tempfile
+import contextvars
+import functools
+import multiprocessing
+from contextlib import ExitStack, closing, contextmanager, nullcontext, suppress
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
 import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError, ConnectionError as BotoConnectionError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Relative store paths (SQLite files, the output spool) are resolved against the app, not the working directory
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Corners considered for placement, in the order results are reported
+CORNERS = ('top-left', 'top-right', 'bottom-left', 'bottom-right')
+
+# Long-edge pixel sizes logos are pre-rendered at; placement picks the closest
+LOGO_ATLAS_SIZES = (48, 64, 96, 128, 192, 256, 384, 512, 768, 1024)
+
+class LogoCache:
+    """Bounded LRU cache of decoded logos keyed by URL, with a per-logo atlas of pre-rendered sizes"""
+    def __init__(self, max_entries=512, ttl=3600, session=None, sizes=LOGO_ATLAS_SIZES):
+        # A Session, or a callable returning one so forked workers each use their own pool
+        self._session = session or requests.Session()
+        self.max_entries = max_entries  # Few hundred brand logos in practice
+        self.ttl = ttl  # Seconds before an entry is revalidated with the origin
+        self.sizes = tuple(sorted(sizes))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self.renders = 0
+
+    @property
+    def session(self):
+        return self._session() if callable(self._session) else self._session
+
+    def _fetch(self, url, entry=None):
+        """Fetch logo, revalidating with ETag/Last-Modified when we have a cached copy"""
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.session.get(url, timeout=10, headers=headers)
+        if entry and response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        # Decode once; later readers share this PIL image
+        logo = Image.open(io.BytesIO(response.content))
+        logo.load()
+        return {
+            'image': logo,
+            'width': logo.size[0],
+            'height': logo.size[1],
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+            'variants': {}
+        }
+
+    def get(self, url, count=True):
+        """Return cache entry for logo URL, downloading or revalidating as needed
+        
+        Hits are counted once per logo fetch. The render and dimension getters pass
+        count=False, since they re-read an entry the request has already fetched.
+        Downloads always count as misses.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry and time.time() - entry['fetched_at'] < self.ttl:
+                self._entries.move_to_end(url)
+                if count:
+                    self.hits += 1
+                return entry
+
+        if entry:
+            try:
+                fresh = self._fetch(url, entry)
+            except Exception:
+                # Origin unreachable - keep serving the stale copy
+                fresh = None
+            with self._lock:
+                self.revalidations += 1
+                if fresh is None:
+                    entry['fetched_at'] = time.time()
+                    if count:
+                        self.hits += 1
+                else:
+                    entry = fresh
+                    self.misses += 1
+                self._store(url, entry)
+            return entry
+
+        entry = self._fetch(url)
+        with self._lock:
+            self.misses += 1
+            self._store(url, entry)
+        return entry
+
+    def _store(self, url, entry):
+        """Insert entry and evict least recently used logos past the bound (lock held)"""
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_dimensions(self, url):
+        """Return native (width, height) of the logo"""
+        entry = self.get(url, count=False)
+        return entry['width'], entry['height']
+
+    def atlas_sizes(self, entry):
+        """Long edges this logo is rendered at: the atlas sizes below its native size, plus native"""
+        native = max(entry['width'], entry['height'])
+        return [size for size in self.sizes if size < native] + [native]
+
+    def get_render(self, url, long_edge):
+        """Premultiplied BGRA render of the logo at the atlas size closest to long_edge
+        
+        Each size is resampled once per logo (on first use, or up front by prerender)
+        and shared by every request after that.
+        """
+        entry = self.get(url, count=False)
+        size = min(self.atlas_sizes(entry), key=lambda candidate: abs(candidate - long_edge))
+        return self._render(entry, size)
+    
+    def get_render_within(self, url, width, height):
+        """Premultiplied BGRA render of the logo fitted to a width x height placement box
+        
+        Starts from the smallest atlas size that covers the box at this logo's own
+        aspect ratio, so fitting only ever scales down; only a box beyond the native
+        size is scaled up. A render that doesn't already match the box (another logo
+        variant sized the placement) is fitted to it: stretched when the aspect ratios
+        are within 10%, otherwise scaled to fit inside it. Fitted renders are kept with
+        the atlas.
+        """
+        entry = self.get(url, count=False)
+        aspect = entry['width'] / entry['height']
+        if abs(aspect - width / height) > 0.1:
+            # Keep the logo's aspect ratio, fit within the box
+            if aspect > width / height:
+                target = (width, max(1, int(width / aspect)))
+            else:
+                target = (max(1, int(height * aspect)), height)
+        else:
+            target = (width, height)
+        
+        # Long edge at which a render covers the target on both axes
+        if aspect >= 1:
+            needed = max(target[0], target[1] * aspect)
+        else:
+            needed = max(target[1], target[0] / aspect)
+        sizes = self.atlas_sizes(entry)
+        size = min((candidate for candidate in sizes if candidate >= needed), default=sizes[-1])
+        render = self._render(entry, size)
+        if (render.shape[1], render.shape[0]) == target:
+            return render
+        fitted = entry['variants'].get(target)
+        if fitted is None:
+            # Premultiplied colour resamples correctly without unpremultiplying
+            shrinking = render.shape[1] >= target[0] and render.shape[0] >= target[1]
+            interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+            fitted = cv2.resize(render, target, interpolation=interpolation)
+            entry['variants'][target] = fitted
+            with self._lock:
+                self.renders += 1
+        return fitted
+    
+    def _render(self, entry, size):
+        render = entry['variants'].get(size)
+        if render is None:
+            render = render_logo(entry['image'], size)
+            entry['variants'][size] = render
+            with self._lock:
+                self.renders += 1
+        return render
+
+    def prerender(self, url):
+        """Fetch the logo and render every atlas size"""
+        entry = self.get(url)
+        for size in self.atlas_sizes(entry):
+            self.get_render(url, size)
+
+    def stats(self):
+        """Counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'revalidations': self.revalidations,
+                'renders': self.renders,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+class PlacementCache:
+    """Size-bounded on-disk (SQLite) cache of per-corner scores keyed by image content and logo size"""
+    def __init__(self, db_path, max_entries=100000):
+        self.db_path = db_path
+        self.max_entries = max_entries  # 0 disables the cache
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._ready = False  # Table created by the first query, so constructing the cache writes no file
+    
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        if not self._ready:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS placements (
+                    key TEXT PRIMARY KEY,
+                    corners TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS placements_last_used ON placements (last_used)')
+            self._ready = True
+        return db
+    
+    def get(self, key):
+        """Return cached corner results, or None"""
+        if not self.max_entries:
+            return None
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT corners FROM placements WHERE key = ?', (key,)).fetchone()
+            if row:
+                db.execute('UPDATE placements SET last_used = ? WHERE key = ?', (time.time(), key))
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row[0]) if row else None
+    
+    def put(self, key, corner_results):
+        """Store corner results, evicting least recently used entries past the bound"""
+        if not self.max_entries:
+            return
+        # numpy scalars (edge density etc.) serialise as plain numbers
+        value = json.dumps(corner_results, default=lambda o: o.item())
+        with closing(self._connect()) as db:
+            db.execute(
+                'INSERT OR REPLACE INTO placements (key, corners, last_used) VALUES (?, ?, ?)',
+                (key, value, time.time())
+            )
+            with self._lock:
+                self._writes += 1
+                check = self._writes % 100 == 1
+            if check:
+                excess = db.execute('SELECT COUNT(*) FROM placements').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    db.execute(
+                        'DELETE FROM placements WHERE key IN (SELECT key FROM placements ORDER BY last_used LIMIT ?)',
+                        (excess,)
+                    )
+                    with self._lock:
+                        self.evictions += excess
+    
+    def stats(self):
+        """Hit/miss/eviction counters for /health"""
+        entries = 0
+        if self.max_entries:
+            with closing(self._connect()) as db:
+                entries = db.execute('SELECT COUNT(*) FROM placements').fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+class OutputSpool:
+    """Local composite storage with a size and age budget
+    
+    Composites are written off the request thread and served from disk. Ones whose
+    S3 upload failed carry a retry record and are re-uploaded in the background.
+    Outputs older than ttl are evicted, then the oldest until the spool fits in
+    max_bytes, with files still waiting for an upload evicted last. The directory
+    may be shared by several processes; each retry record is claimed by one of them,
+    and a claim older than claim_timeout is released for another to take over.
+    """
+    def __init__(self, directory='outputs', max_bytes=2048 * 1024 * 1024, ttl=24 * 3600, sweep_interval=60, claim_timeout=900, metrics=None):
+        # Absolute, so returned paths and send_file don't depend on the working directory
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.claim_timeout = claim_timeout
+        self.metrics = metrics
+        self.uploader = None  # uploader(encoded, s3_url) -> composite URL or None
+        self._start_lock = threading.Lock()
+        self.after_fork()
+    
+    @property
+    def retry_dir(self):
+        # Retry records: <output name>.json, or .json.<pid> while a process is uploading it
+        return os.path.join(self.directory, '.retry')
+    
+    def after_fork(self):
+        """Writer pool, janitor thread and counters belong to the process that started them"""
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='spool-write')
+        self._pending = {}  # Output name -> Future of a write not yet on disk
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._written = 0  # Bytes written since the last sweep
+        self._last = {'files': 0, 'bytes': 0, 'awaiting_upload': 0}
+    
+    def shutdown(self, wait=True):
+        """Stop accepting writes, letting queued ones finish when wait is set"""
+        self._pool.shutdown(wait=wait)
+    
+    def start(self):
+        """Start the background retry and eviction thread once per process"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._maintain, name='spool-maintenance', daemon=True)
+                self._thread.start()
+    
+    def write(self, encoded, retry_url=None):
+        """Queue an encoded composite for writing and return its path straight away
+        
+        With retry_url (an S3 original) the file is re-uploaded beside it in the background.
+        """
+        name = f"output_{uuid.uuid4().hex[:8]}.{encoded['extension']}"
+        # Placeholder before returning, so another worker asked for the file knows it's on its way
+        os.makedirs(self.retry_dir, exist_ok=True)
+        open(os.path.join(self.directory, f".{name}.tmp"), 'wb').close()
+        with self._lock:
+            self._pending[name] = self._pool.submit(self._write, name, encoded, retry_url)
+        self.start()
+        return os.path.join(self.directory, name)
+    
+    def _write(self, name, encoded, retry_url):
+        try:
+            with self.metrics.span('local_save') if self.metrics else nullcontext():
+                # Write beside, then rename, so readers and the sweep never see a partial file
+                tmp = os.path.join(self.directory, f".{name}.tmp")
+                with open(tmp, 'wb') as f:
+                    f.write(encoded['data'])
+                os.replace(tmp, os.path.join(self.directory, name))
+                if retry_url:
+                    record = {key: encoded[key] for key in ('format', 'extension', 'content_type')}
+                    record['s3_url'] = retry_url
+                    record['size'] = len(encoded['data'])
+                    tmp = os.path.join(self.retry_dir, f".{name}.json.tmp")
+                    with open(tmp, 'w') as f:
+                        json.dump(record, f)
+                    os.replace(tmp, os.path.join(self.retry_dir, f"{name}.json"))
+            with self._lock:
+                self._written += len(encoded['data'])
+                over_budget = self._last['bytes'] + self._written > self.max_bytes
+            if over_budget:
+                self._wakeup.set()  # Over budget: sweep now rather than at the next interval
+        except Exception as e:
+            print(f"Spool write failed for {name}: {e}")
+            if self.metrics:
+                self.metrics.inc('spool', 'write_error')
+            with suppress(OSError):
+                os.remove(os.path.join(self.directory, f".{name}.tmp"))
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+    
+    def path(self, name, wait=1.0):
+        """Path of a servable output, waiting up to wait seconds for one still being written; None if absent or expired
+        
+        Only a write in flight is waited for, so unknown names are answered at once.
+        """
+        if os.path.basename(name) != name or not name.startswith('output_'):
+            return None
+        with self._lock:
+            future = self._pending.get(name)
+        if future:
+            wait_futures([future], timeout=wait)
+        path = os.path.join(self.directory, name)
+        # Being written by another worker: its placeholder is there until the file is renamed into place
+        placeholder = os.path.join(self.directory, f".{name}.tmp")
+        deadline = time.monotonic() + wait
+        while not os.path.exists(path) and os.path.exists(placeholder) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+    
+    def remove(self, path):
+        """Delete a spooled output and its retry record; False if path isn't a spool output"""
+        name = os.path.basename(path)
+        if os.path.abspath(path) != os.path.join(self.directory, name) or not name.startswith('output_'):
+            return False
+        os.remove(path)
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(self.retry_dir, f"{name}.json"))
+        return True
+    
+    def _maintain(self):
+        while True:
+            self._wakeup.wait(timeout=self.sweep_interval)
+            self._wakeup.clear()
+            try:
+                self.retry_uploads()
+                self.sweep()
+            except Exception as e:
+                print(f"Spool maintenance error: {e}")
+    
+    def retry_uploads(self):
+        """Re-upload composites whose S3 upload failed, straight from a memory map of the spooled file"""
+        if not self.uploader or not os.path.isdir(self.retry_dir):
+            return
+        for record_name in os.listdir(self.retry_dir):
+            record_path = os.path.join(self.retry_dir, record_name)
+            base, _, pid = record_name.rpartition('.')
+            if base.endswith('.json') and pid.isdigit():
+                # Claim outlived any upload (its worker died or hung): release it for the next pass.
+                # Judged by age, as the PID may since belong to another process
+                with suppress(OSError):
+                    if time.time() - os.path.getmtime(record_path) > self.claim_timeout:
+                        os.rename(record_path, os.path.join(self.retry_dir, base))
+                continue
+            if not record_name.endswith('.json') or record_name.startswith('.'):
+                continue
+            
+            # Rename is atomic, so only one process uploads each file
+            claimed = f"{record_path}.{os.getpid()}"
+            try:
+                os.rename(record_path, claimed)
+                os.utime(claimed)  # The claim's age starts now, not when the record was written
+            except FileNotFoundError:
+                continue
+            name = record_name[:-len('.json')]
+            try:
+                with open(claimed) as f:
+                    record = json.load(f)
+                s3_url = record['s3_url']
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size != record.get('size', size):
+                        raise ValueError(f"truncated to {size} of {record['size']} bytes")
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # ValueError when empty
+            except FileNotFoundError:
+                os.remove(claimed)  # Output already evicted or removed; nothing left to upload
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                # Empty, truncated or corrupt: every later pass would fail the same way
+                print(f"Dropping unreadable spool upload for {name}: {e}")
+                os.remove(claimed)
+                if self.metrics:
+                    self.metrics.inc('spool', 'dropped')
+                continue
+            try:
+                uploaded = self.uploader({**record, 'data': data}, s3_url)
+            except Exception as e:
+                print(f"Spool upload retry failed for {name}: {e}")
+                uploaded = None
+            finally:
+                data.close()
+            # The claim may have been released meanwhile if the upload outlasted claim_timeout
+            with suppress(FileNotFoundError):
+                if uploaded:
+                    os.remove(claimed)
+                else:
+                    os.rename(claimed, record_path)  # Try again next pass
+            if uploaded and self.metrics:
+                self.metrics.inc('spool', 'uploaded')
+    
+    def sweep(self):
+        """Evict expired outputs, then the oldest (awaiting upload last) until under max_bytes"""
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        with self._lock:
+            self._written = 0
+        waiting = set(os.listdir(self.retry_dir)) if os.path.isdir(self.retry_dir) else set()
+        outputs = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.output_') and entry.name.endswith('.tmp'):
+                    # Placeholder or partial write left by a worker that died mid-write
+                    with suppress(FileNotFoundError):
+                        if now - entry.stat().st_mtime > self.ttl:
+                            os.remove(entry.path)
+                    continue
+                if not entry.name.startswith('output_') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                awaiting = f"{entry.name}.json" in waiting
+                outputs.append((awaiting, stat.st_mtime, stat.st_size, entry.name))
+        
+        total = sum(size for _, _, size, _ in outputs)
+        kept = {'files': 0, 'bytes': 0, 'awaiting_upload': 0}
+        for awaiting, mtime, size, name in sorted(outputs):
+            expired = now - mtime > self.ttl
+            if expired or total > self.max_bytes:
+                with suppress(FileNotFoundError):
+                    self.remove(os.path.join(self.directory, name))
+                    if self.metrics:
+                        self.metrics.inc('spool', 'expired' if expired else 'evicted')
+                total -= size
+                continue
+            kept['files'] += 1
+            kept['bytes'] += size
+            kept['awaiting_upload'] += awaiting
+        self._last = kept
+    
+    def stats(self):
+        """Spool size as of the last sweep, plus writes still in flight"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'files': self._last['files'],
+            'size_mb': round(self._last['bytes'] / (1024 * 1024), 1),
+            'max_size_mb': round(self.max_bytes / (1024 * 1024), 1),
+            'awaiting_upload': self._last['awaiting_upload'],
+            'pending_writes': pending
+        }
+
+# Per-request stage timings, collected while a caller is inside Metrics.collect()
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+class Metrics:
+    """Stage latency histograms and outcome counters in shared memory
+
+    Built before gunicorn forks, so any worker can serve /metrics for the whole
+    service. Each process writes only its own slot (slot 0 is the master or a
+    lone process) and render() sums the slots, so no lock is shared between
+    processes and a worker killed mid-update can't block the others. Its counts
+    stay in the slot for the replacement worker to carry on from.
+    """
+    STAGES = (
+        'request', 'download', 'decode', 'decode_full', 'logo_fetch', 'text_detection', 'features',
+        'corner_analysis', 'composite', 'encode', 's3_upload', 'local_save', 's3_delete', 'admission_wait'
+    )
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    COUNTERS = {
+        'requests': ('status', ('successful', 'failed')),
+        'failures': ('reason', (
+            'no_corner', 'insufficient_space', 'low_confidence', 'download_error',
+            'image_too_large', 'decode_error', 'processing_error', 's3_upload_error', 's3_delete_error'
+        )),
+        'rejections': ('reason', ('queue_full', 'queue_timeout', 'memory_timeout')),
+        'spool': ('event', ('uploaded', 'expired', 'evicted', 'write_error', 'dropped'))
+    }
+    
+    def __init__(self, prefix='logo_placement', slots=64):
+        self.prefix = prefix
+        self.slots = slots
+        self._row = len(self.BUCKETS) + 3  # Per-bucket counts, +Inf, sum, count
+        self._counter_offsets = {}
+        offset = len(self.STAGES) * self._row
+        for name, (_, labels) in self.COUNTERS.items():
+            self._counter_offsets[name] = offset
+            offset += len(labels)
+        self._width = offset
+        self._values = multiprocessing.RawArray('d', offset * slots)
+        self._base = 0
+        self.after_fork()
+    
+    def after_fork(self, slot=None):
+        """Fresh lock for this process's threads; with slot, write into that slot from now on"""
+        self._lock = threading.Lock()
+        if slot is not None:
+            if not 0 <= slot < self.slots:
+                raise ValueError(f"Metrics slot {slot} out of range (METRICS_WORKER_SLOTS={self.slots})")
+            self._base = slot * self._width
+    
+    def observe(self, stage, seconds):
+        base = self._base + self.STAGES.index(stage) * self._row
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            self._values[base + bucket] += 1
+            self._values[base + len(self.BUCKETS) + 1] += seconds
+            self._values[base + len(self.BUCKETS) + 2] += 1
+    
+    def inc(self, name, label):
+        index = self._base + self._counter_offsets[name] + self.COUNTERS[name][1].index(label)
+        with self._lock:
+            self._values[index] += 1
+    
+    @contextmanager
+    def span(self, stage):
+        """Time the enclosed block into the stage histogram (and the request breakdown, if collecting)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(stage, elapsed)
+            timings = _request_timings.get()
+            if timings is not None:
+                timings.append((stage, elapsed))
+    
+    @contextmanager
+    def collect(self):
+        """Collect a per-stage breakdown in milliseconds for work done inside the block
+        
+        Stages run on pool threads only count when submitted via run_in_context; stages
+        that run once per corner are summed.
+        """
+        timings = []
+        breakdown = {}
+        token = _request_timings.set(timings)
+        try:
+            yield breakdown
+        finally:
+            _request_timings.reset(token)
+            for stage, elapsed in timings:
+                breakdown[stage] = round(breakdown.get(stage, 0.0) + elapsed * 1000, 2)
+    
+    def render(self):
+        """Prometheus text exposition format, summed over every process's slot"""
+        width = self._width
+        values = [sum(column) for column in zip(*(
+            self._values[slot * width:(slot + 1) * width] for slot in range(self.slots)
+        ))]
+        
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each processing stage", f"# TYPE {name} histogram"]
+        for i, stage in enumerate(self.STAGES):
+            row = values[i * self._row:(i + 1) * self._row]
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), row):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {int(cumulative)}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {row[-2]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {int(row[-1])}')
+        
+        for counter, (label, label_values) in self.COUNTERS.items():
+            name = f"{self.prefix}_{counter}_total"
+            lines += [f"# HELP {name} Placement {counter} by {label}", f"# TYPE {name} counter"]
+            offset = self._counter_offsets[counter]
+            for j, value in enumerate(label_values):
+                lines.append(f'{name}{{{label}="{value}"}} {int(values[offset + j])}')
+        return '\n'.join(lines) + '\n'
+
+def run_in_context(fn):
+    """Wrap fn to run in a copy of the caller's context, so pool threads report into its timings"""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+def timed(stage):
+    """Method decorator recording the call's duration under stage in self.metrics"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(stage):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class DownloadError(ValueError):
+    """Image could not be fetched"""
+
+class ImageTooLargeError(DownloadError):
+    """Image is over the byte or pixel ceiling"""
+
+class DecodeError(ValueError):
+    """Image bytes could not be decoded"""
+
+def failure_reason(error):
+    """Failure counter label for an exception raised while processing an image"""
+    if isinstance(error, ImageTooLargeError):
+        return 'image_too_large'
+    if isinstance(error, DownloadError):
+        return 'download_error'
+    if isinstance(error, DecodeError):
+        return 'decode_error'
+    return 'processing_error'
+
+def retryable_s3_error(error):
+    """Whether an S3 call is worth retrying: throttling, 5xx and connection failures
+    
+    Anything else (AccessDenied, NoSuchBucket, missing credentials) fails the same way every time.
+    """
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return status >= 500 or status == 429 or code in ('Throttling', 'ThrottlingException', 'SlowDown', 'RequestTimeout')
+    return isinstance(error, (BotoConnectionError, HTTPClientError))
+
+class OverloadedError(Exception):
+    """Turned away by admission control; retry_after is a hint in seconds"""
+    status = 503
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class QueueFullError(OverloadedError):
+    """Admission wait queue is full"""
+    status = 429
+
+# The admission a request holds, so the image header check can reserve memory against it
+_admission_ticket = contextvars.ContextVar('admission_ticket', default=None)
+
+class AdmissionController:
+    """Caps in-flight placements in this process by count and by estimated memory
+    
+    Callers wait for a slot in a bounded queue. Once the image header has been
+    parsed they also reserve the image's estimated working memory. Callers that
+    find the queue full, or pass their deadline while waiting for either, get an
+    OverloadedError with a Retry-After hint instead of piling onto the process.
+    """
+    def __init__(self, max_inflight=4, max_memory=2048 * 1024 * 1024, max_queue=8, queue_timeout=10.0, metrics=None):
+        self.max_inflight = max_inflight  # 0 = no count limit
+        self.max_memory = max_memory  # Bytes; 0 = no memory limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.metrics = metrics
+        self.after_fork()
+    
+    def after_fork(self):
+        """Fresh lock and counters; admissions belong to the process that holds them"""
+        self._cond = threading.Condition()
+        self.inflight = 0
+        self.queued = 0
+        self.memory = 0
+        self.rejected = {reason: 0 for reason in Metrics.COUNTERS['rejections'][1]}
+        self.hold_seconds = 1.0  # Moving average of how long a slot is held, for Retry-After
+    
+    def retry_after(self):
+        """Seconds for the queue ahead to drain at the recent pace"""
+        slots = self.max_inflight or 1
+        return max(1, min(60, math.ceil((self.queued + 1) * self.hold_seconds / slots)))
+    
+    def _reject(self, reason, message):
+        # Called with the condition held
+        self.rejected[reason] += 1
+        if self.metrics:
+            self.metrics.inc('rejections', reason)
+        error = QueueFullError if reason == 'queue_full' else OverloadedError
+        raise error(message, self.retry_after())
+    
+    def _wait(self, deadline, blocked, reason, message):
+        # Called with the condition held
+        while blocked():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self._reject(reason, message)
+            self._cond.wait(remaining)
+    
+    @contextmanager
+    def admit(self, timeout=None):
+        """Hold an in-flight slot for the block
+        
+        With a timeout the caller is rejected when the queue is full or the timeout
+        passes. With None (background jobs, batch items) it waits as long as it takes,
+        outside the queue bound, since its own pool already bounds it.
+        """
+        start = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = {'deadline': deadline, 'memory': 0}
+        slots_full = lambda: self.max_inflight and self.inflight >= self.max_inflight
+        with self._cond:
+            if slots_full():
+                if timeout is not None and self.queued >= self.max_queue:
+                    self._reject('queue_full', f"Server busy: {self.queued} requests already waiting")
+                self.queued += 1
+                try:
+                    self._wait(deadline, slots_full, 'queue_timeout', f"Server busy: no slot free within {timeout}s")
+                finally:
+                    self.queued -= 1
+            self.inflight += 1
+        admitted = time.perf_counter()
+        if self.metrics:
+            self.metrics.observe('admission_wait', admitted - start)
+        
+        token = _admission_ticket.set(ticket)
+        try:
+            yield ticket
+        finally:
+            _admission_ticket.reset(token)
+            with self._cond:
+                self.inflight -= 1
+                self.memory -= ticket['memory']
+                self.hold_seconds += 0.2 * (time.perf_counter() - admitted - self.hold_seconds)
+                self._cond.notify_all()
+    
+    def reserve(self, estimate):
+        """Reserve estimate bytes for the current admission, waiting within its deadline
+        
+        A no-op outside admit(). An image over the whole budget runs once it has the
+        budget to itself.
+        """
+        ticket = _admission_ticket.get()
+        if ticket is None or not self.max_memory:
+            return
+        estimate = min(estimate, self.max_memory)
+        with self._cond:
+            # A second reservation (e.g. a re-read image) replaces the first
+            self.memory -= ticket['memory']
+            ticket['memory'] = 0
+            self._cond.notify_all()
+            self._wait(
+                ticket['deadline'], lambda: self.memory + estimate > self.max_memory, 'memory_timeout',
+                f"Server busy: not enough memory free for this image within {self.queue_timeout}s"
+            )
+            self.memory += estimate
+            ticket['memory'] = estimate
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'inflight': self.inflight,
+                'queued': self.queued,
+                'max_inflight': self.max_inflight,
+                'max_queue': self.max_queue,
+                'memory_reserved_mb': round(self.memory / (1024 * 1024), 1),
+                'max_memory_mb': round(self.max_memory / (1024 * 1024), 1),
+                'rejected': dict(self.rejected),
+                'retry_after': self.retry_after()
+            }
+
+def render_logo(pil_logo, long_edge):
+    """Resample the logo so its long edge is long_edge (keeping aspect) as premultiplied BGRA uint8
+    
+    Premultiplied colour lets compositing blend with one multiply-add per pixel.
+    """
+    width, height = pil_logo.size
+    ratio = long_edge / max(width, height)
+    logo = pil_logo.convert('RGBA')
+    if ratio != 1:
+        logo = logo.resize((max(1, round(width * ratio)), max(1, round(height * ratio))), Image.LANCZOS)
+    
+    bgra = cv2.cvtColor(np.array(logo), cv2.COLOR_RGBA2BGRA)
+    alpha = bgra[:, :, 3:].astype(np.uint16)
+    bgra[:, :, :3] = (bgra[:, :, :3] * alpha + 127) // 255
+    return bgra
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over an existing buffer, so uploads stream it without a bytes copy"""
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, min(offset, len(self._view)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+def pil_to_array(image):
+    """PIL image as an OpenCV array: BGR, BGRA (transparent inputs) or gray"""
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    array = np.array(image)
+    if image.mode == 'RGB':
+        array = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+    elif image.mode == 'RGBA':
+        array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA)
+    return array
+
+def array_to_pil(array, mode):
+    """OpenCV array (BGR, BGRA or gray) as a PIL image in mode ('RGB' or 'RGBA')"""
+    if array.ndim == 2:
+        array = cv2.cvtColor(array, cv2.COLOR_GRAY2BGR)
+    if mode == 'RGBA':
+        code = cv2.COLOR_BGRA2RGBA if array.shape[2] == 4 else cv2.COLOR_BGR2RGBA
+    else:
+        code = cv2.COLOR_BGRA2RGB if array.shape[2] == 4 else cv2.COLOR_BGR2RGB
+    return Image.fromarray(cv2.cvtColor(array, code))
+
+def working_size(width, height, max_size):
+    """(width, height) scaled so the longest edge fits max_size (unchanged when it already does)"""
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+    ratio = max_size / max(width, height)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def to_gray(image):
+    """Grayscale view of a BGR, BGRA or already-gray image"""
+    if len(image.shape) == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def window_sums(sat, xs, ys, width, height):
+    """Sum over every width x height window at (xs, ys) from a summed-area table, shape (len(ys), len(xs))"""
+    top, bottom = ys[:, None], ys[:, None] + height
+    left, right = xs[None, :], xs[None, :] + width
+    return sat[bottom, right] - sat[top, right] - sat[bottom, left] + sat[top, left]
+
+def rect_sums(sat, x1, y1, x2, y2):
+    """Sums over rectangles [x1, x2) x [y1, y2) from a summed-area table; coordinates may be arrays"""
+    return sat[y2, x2] - sat[y1, x2] - sat[y2, x1] + sat[y1, x1]
+
+# Output encodings: content type and file extension per format
+OUTPUT_FORMATS = {
+    'jpeg': {'content_type': 'image/jpeg', 'extension': 'jpg', 'aliases': ('jpg', 'jpeg')},
+    'png': {'content_type': 'image/png', 'extension': 'png', 'aliases': ('png',)},
+    'webp': {'content_type': 'image/webp', 'extension': 'webp', 'aliases': ('webp',)}
+}
+
+# PIL format names we can write back in kind; anything else is written as PNG
+SOURCE_FORMATS = {'JPEG': 'jpeg', 'MPO': 'jpeg', 'PNG': 'png', 'WEBP': 'webp'}
+
+# PIL formats whose decoder can downscale while decoding (draft(), libjpeg's 1/2-1/8 scaling).
+# Everything else builds the full-resolution buffer before it can be reduced.
+DRAFT_FORMATS = {'JPEG', 'MPO'}
+
+# Containers multi-frame inputs are written back in (animated WebP uses OUTPUT_FORMATS['webp']).
+# Videos are encoded through OpenCV with the given fourcc.
+MULTIFRAME_FORMATS = {
+    'gif': {'content_type': 'image/gif', 'extension': 'gif', 'aliases': ('gif',)},
+    'tiff': {'content_type': 'image/tiff', 'extension': 'tiff', 'aliases': ('tif', 'tiff')},
+    'mp4': {'content_type': 'video/mp4', 'extension': 'mp4', 'aliases': ('mp4', 'm4v'), 'fourcc': 'mp4v'},
+    'mov': {'content_type': 'video/quicktime', 'extension': 'mov', 'aliases': ('mov',), 'fourcc': 'mp4v'},
+    'webm': {'content_type': 'video/webm', 'extension': 'webm', 'aliases': ('webm',), 'fourcc': 'VP80'},
+    'mkv': {'content_type': 'video/x-matroska', 'extension': 'mkv', 'aliases': ('mkv',), 'fourcc': 'mp4v'},
+    'avi': {'content_type': 'video/x-msvideo', 'extension': 'avi', 'aliases': ('avi',), 'fourcc': 'MJPG'}
+}
+
+def format_spec(name):
+    """Content type, extension and aliases of an encoded output's format"""
+    return OUTPUT_FORMATS.get(name) or MULTIFRAME_FORMATS[name]
+
+def parse_output_options(data):
+    """Read per-request output encoding options, raising ValueError on bad values"""
+    output = {}
+    if data.get('output_format') is not None:
+        output_format = str(data['output_format']).lower()
+        output_format = 'jpeg' if output_format == 'jpg' else output_format
+        if output_format != 'source' and output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output_format: {data['output_format']}. Use source, jpeg, png or webp")
+        output['format'] = output_format
+    if data.get('output_quality') is not None:
+        quality = int(data['output_quality'])
+        if not 1 <= quality <= 100:
+            raise ValueError('output_quality must be between 1 and 100')
+        output['quality'] = quality
+    if data.get('png_compression') is not None:
+        compression = int(data['png_compression'])
+        if not 0 <= compression <= 9:
+            raise ValueError('png_compression must be between 0 and 9')
+        output['png_compression'] = compression
+    if data.get('optimize') is not None:
+        output['optimize'] = bool(data['optimize'])
+    return output
+
+def serialise_result(result):
+    """JSON-safe copy of a result, with an inline composite as base64"""
+    if isinstance(result.get('output_image_data'), (bytes, bytearray)):
+        result = {**result, 'output_image_data': base64.b64encode(result['output_image_data']).decode('ascii')}
+    return result
+
+class FrameSequence(Image.Image):
+    """Frames produced one at a time, as a multi-frame image PIL's WebP/TIFF save_all can consume
+    
+    Those savers walk n_frames with seek(); each seek pulls the next array from the
+    iterator, so only the current frame is ever held. Seeks back (the savers
+    restore their start position when done) are ignored. This sets Image
+    internals (_mode, _size, im), so requirements.txt pins pillow to the
+    releases it is tested against.
+    """
+    def __init__(self, arrays, count, mode, size):
+        super().__init__()
+        self._arrays = iter(arrays)
+        self._index = -1
+        self._mode = mode
+        self._size = size
+        self.n_frames = count
+        self.seek(0)
+    
+    def seek(self, frame):
+        if frame <= self._index:
+            return
+        if frame != self._index + 1:
+            raise EOFError("Frames can only be read in order")
+        self.im = array_to_pil(next(self._arrays), self._mode).im
+        self._index = frame
+    
+    def tell(self):
+        return self._index
+
+class AnimatedFrames:
+    """Animated GIF/WebP or multi-page TIFF, decoded a frame at a time"""
+    FORMATS = {'GIF': 'gif', 'WEBP': 'webp', 'TIFF': 'tiff'}
+    
+    def __init__(self, image):
+        self.image = image
+        self.format = self.FORMATS[image.format]
+        self.count = image.n_frames
+        self.size = image.size
+        self.loop = image.info.get('loop')  # Plays, as the container counts them; None: a GIF that plays once
+    
+    def _seek(self, index):
+        self.image.seek(index)
+        # GIF/WebP frame delay in ms (TIFF pages have none)
+        return pil_to_array(self.image), self.image.info.get('duration', 100)
+    
+    def sample(self, count, max_size):
+        """count frames spread evenly over the sequence, at working size"""
+        size = working_size(*self.size, max_size)
+        samples = []
+        for index in sorted(set(np.linspace(0, self.count - 1, count).round().astype(int).tolist())):
+            frame = self._seek(index)[0]
+            samples.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if size != self.size else frame)
+        return samples
+    
+    def frames(self):
+        """Yield every full-resolution frame in order; the frame's delay is in self.durations"""
+        self.durations = []
+        for index in range(self.count):
+            frame, duration = self._seek(index)
+            self.durations.append(duration)
+            yield frame
+    
+    def write(self, frames, quality=90):
+        """Encode the frames back into the source container, one frame in memory at a time"""
+        buffer = io.BytesIO()
+        if self.format == 'gif':
+            self._write_gif(buffer, frames)
+        else:
+            arrays = iter(frames)
+            first = next(arrays)
+            mode = 'RGBA' if self.format == 'webp' or (first.ndim == 3 and first.shape[2] == 4) else 'RGB'
+            sequence = FrameSequence(itertools.chain([first], arrays), self.count, mode, self.size)
+            if self.format == 'webp':
+                # The saver reads frame i's delay after seeking to it, by which point it's been appended
+                loop = {} if self.loop is None else {'loop': self.loop}
+                sequence.save(buffer, format='WEBP', save_all=True, duration=self.durations, quality=quality, **loop)
+            else:
+                sequence.save(buffer, format='TIFF', save_all=True, compression='tiff_deflate')
+        return buffer.getvalue()
+    
+    def _write_gif(self, buffer, frames):
+        # PIL's GIF save_all keeps every frame until the end, so write frame by frame instead
+        # with GifImagePlugin's lower-level writers (covered by the pillow pin too)
+        for index, frame in enumerate(frames):
+            transparent = frame.ndim == 3 and frame.shape[2] == 4 and (frame[:, :, 3] < 128).any()
+            # Fast octree: a per-frame median-cut palette costs more than the rest of the frame's work
+            paletted = array_to_pil(frame, 'RGB').quantize(255 if transparent else 256, method=Image.Quantize.FASTOCTREE)
+            params = {'duration': self.durations[index], 'disposal': 1, 'include_color_table': True}
+            if transparent:
+                # Reserve the last palette entry for transparent pixels
+                pixels = np.array(paletted)
+                pixels[frame[:, :, 3] < 128] = 255
+                palette = paletted.getpalette()[:255 * 3]
+                paletted = Image.fromarray(pixels)  # 'L', made 'P' by putpalette
+                paletted.putpalette(palette + [0] * (768 - len(palette)))
+                params.update(transparency=255, disposal=2)
+            if index == 0:
+                header, _ = GifImagePlugin.getheader(paletted, None, {} if self.loop is None else {'loop': self.loop})
+                buffer.writelines(header)
+            buffer.writelines(GifImagePlugin.getdata(paletted, (0, 0), **params))
+        buffer.write(b';')
+    
+    def close(self):
+        self.image.close()
+
+class VideoFrames:
+    """Video clip read and written a frame at a time through OpenCV's FFmpeg backend
+    
+    OpenCV only reads from a file, so the clip is spooled to a temp file. Audio
+    tracks are not carried over.
+    """
+    def __init__(self, data, container):
+        self.format = container
+        spec = MULTIFRAME_FORMATS[container]
+        with tempfile.NamedTemporaryFile(suffix=f".{spec['extension']}", delete=False) as f:
+            f.write(data)
+            self.path = f.name
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            self.close()
+            raise ValueError(f"Unreadable {container} video")
+        self.size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 25.0
+        self.count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.count <= 0:
+            # Some containers don't record a frame count; count by demuxing
+            self.count = 0
+            while self.capture.grab():
+                self.count += 1
+    
+    def sample(self, count, max_size):
+        """count frames spread evenly over the clip, at working size"""
+        size = working_size(*self.size, max_size)
+        samples = []
+        for index in sorted(set(np.linspace(0, self.count - 1, count).round().astype(int).tolist())):
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ok, frame = self.capture.read()
+            if ok:
+                samples.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if size != self.size else frame)
+        if not samples:
+            raise ValueError(f"No frames could be decoded from the {self.format} video")
+        return samples
+    
+    def frames(self):
+        """Yield every full-resolution frame in order"""
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        while True:
+            ok, frame = self.capture.read()
+            if not ok:
+                return
+            yield frame
+    
+    def write(self, frames, quality=90):
+        """Encode the frames into the source container at the source frame rate (quality is left to the codec)"""
+        spec = MULTIFRAME_FORMATS[self.format]
+        with tempfile.NamedTemporaryFile(suffix=f".{spec['extension']}", delete=False) as f:
+            path = f.name
+        try:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*spec['fourcc']), self.fps, self.size)
+            if not writer.isOpened():
+                raise ValueError(f"No {spec['fourcc']} encoder available for {self.format} output")
+            try:
+                for frame in frames:
+                    writer.write(frame)
+            finally:
+                writer.release()
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+    
+    def close(self):
+        if hasattr(self, 'capture'):
+            self.capture.release()
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+def video_container(data):
+    """Container name for video bytes we can read, from the file signature, else None"""
+    head = bytes(data[:64])
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'avif', b'avis', b'heic', b'heix', b'mif1', b'msf1'):
+            return None  # Still images in an ISO media container
+        return 'mov' if brand == b'qt  ' else 'mp4'
+    if head.startswith(b'\x1aE\xdf\xa3'):
+        return 'webm' if b'webm' in head else 'mkv'
+    if head.startswith(b'RIFF') and head[8:12] == b'AVI ':
+        return 'avi'
+    return None
+
+class TesseractTextDetector:
+    """Slow but exact text detection by running Tesseract on the corner mosaic"""
+    name = 'tesseract'
+
+    def __init__(self, max_size=2000, min_confidence=0):
+        self.max_size = max_size  # Longest mosaic edge sent to Tesseract
+        self.min_confidence = min_confidence  # Word confidence (0-100) counted as text
+
+    def detect(self, gray):
+        """Return (x, y, w, h, confidence, text) for each word found"""
+        data = pytesseract.image_to_data(gray, output_type=pytesseract.Output.DICT)
+        boxes = []
+        for i, text in enumerate(data['text']):
+            confidence = float(data['conf'][i])
+            if not text.strip() or confidence < self.min_confidence:
+                continue
+            boxes.append((data['left'][i], data['top'][i], data['width'][i], data['height'][i], confidence, text))
+        return boxes
+
+class MserTextDetector:
+    """Fast in-process text detection from MSER character candidates grouped into lines"""
+    name = 'mser'
+
+    def __init__(self, max_size=1200, min_chars=3):
+        self.max_size = max_size  # Longest mosaic edge analysed
+        self.min_chars = min_chars  # Character candidates needed to call a line text
+
+    def detect(self, gray):
+        """Return (x, y, w, h, confidence, text) for each text line found"""
+        h, w = gray.shape[:2]
+        # cv2.MSER instances are not thread-safe, so build one per call (cheap).
+        # min_diversity=0 keeps glyphs whose parent region is almost identical (flat, high-contrast text)
+        mser = cv2.MSER_create(delta=5, min_area=20, max_area=8000, min_diversity=0.0)
+        # Light blur keeps sensor noise from fragmenting glyph regions
+        _, bboxes = mser.detectRegions(cv2.GaussianBlur(gray, (3, 3), 0))
+        if len(bboxes) == 0:
+            return []
+
+        # Nested MSER levels often repeat the same box
+        bboxes = np.unique(np.asarray(bboxes), axis=0)
+        bw, bh = bboxes[:, 2], bboxes[:, 3]
+        # Character-like candidates: modest height, upright-ish aspect
+        keep = (bh >= 6) & (bh <= h // 6) & (bw <= bh * 2) & (bw * 8 >= bh)
+        chars = bboxes[keep]
+        if len(chars) < self.min_chars:
+            return []
+
+        # Join neighbouring characters into lines by smearing horizontally
+        mask = np.zeros((h, w), dtype=np.uint8)
+        for x, y, cw, ch in chars:
+            mask[y:y + ch, x:x + cw] = 255
+        median_h = int(np.median(chars[:, 3]))
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, median_h), 1))
+        mask = cv2.dilate(mask, kernel)
+
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+        centres_x = chars[:, 0] + chars[:, 2] // 2
+        centres_y = chars[:, 1] + chars[:, 3] // 2
+        char_labels = labels[centres_y, centres_x]
+
+        boxes = []
+        for label in range(1, count):
+            x, y, lw, lh, _ = stats[label]
+            members = chars[char_labels == label]
+            # Nested MSER levels repeat each glyph; count distinct glyph positions
+            glyphs = len(np.unique((members[:, 0] + members[:, 2] // 2) // max(2, median_h // 2)))
+            # Text lines are wider than tall and made of similar-height glyphs
+            if glyphs < self.min_chars or lw < lh * 1.5:
+                continue
+            heights = members[:, 3]
+            if np.std(heights) > np.mean(heights) * 0.5:
+                continue
+            confidence = min(100.0, 100.0 * glyphs / (glyphs + self.min_chars))
+            boxes.append((int(x), int(y), int(lw), int(lh), confidence, ''))
+        return boxes
+
+class PlacementPipeline:
+    """Staged placement: decode → features → score → select → composite → encode → store
+    
+    Every entry point runs some or all of the stages, in order, over one state
+    dict that each stage reads and extends. Inputs are source, logo_urls (dark,
+    light), text_detector, corners, and for the later stages composite/output/
+    upload_to_s3/delete_original/inline. A stage that reaches a final failure
+    sets state['done'] and the run stops there.
+    
+    Hooks are called as hook(stage, state) and return a context manager entered
+    around each stage. That lets caching or instrumentation wrap stages without
+    touching them; a hook skips a stage by adding it to state['skip'].
+    """
+    STAGES = ('decode', 'features', 'score', 'select', 'composite', 'encode', 'store')
+    
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.hooks = []
+    
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+    
+    def run(self, state, stages=STAGES):
+        """Run the given stages (in pipeline order) over state and return it"""
+        state.setdefault('skip', set())
+        state.setdefault('corners', list(CORNERS))
+        try:
+            for stage in self.STAGES:
+                if stage not in stages or state.get('done'):
+                    continue
+                with ExitStack() as stack:
+                    for hook in self.hooks:
+                        stack.enter_context(hook(stage, state))
+                    if stage not in state['skip']:
+                        getattr(self, stage)(state)
+        finally:
+            # A frame sequence holds a decoder (and for video a temp file) until the run ends
+            if state.get('frames'):
+                state['frames'].close()
+        return state
+    
+    def decode(self, state):
+        """Fetch and decode the working copy, sizing the logo against the full-resolution image"""
+        a = self.analyzer
+        dark_logo_url, light_logo_url = state.get('logo_urls', (None, None))
+        # Fetch both logo variants into the cache while the image downloads
+        logo_futures = [
+            a.fetch_pool.submit(run_in_context(a.fetch_logo), logo_url)
+            for logo_url in (dark_logo_url, light_logo_url) if logo_url
+        ]
+        
+        # Download once; score on a downscaled working copy. Oversized images are rejected from
+        # the header before the body is read; only a JPEG working decode can stay under the
+        # ceiling without building the full-resolution buffer
+        full_resolution = state.get('composite', False)
+        max_pixels = a.max_image_pixels
+        image_data = a.fetch_image(
+            state['source'], max_pixels, a.reserve_memory(full_resolution), downscaled=not full_resolution
+        )
+        frames = a.open_frames(image_data)
+        if frames:
+            # Animated image or video: score frames sampled across it; compositing streams every frame
+            state['frames'] = frames
+            a.reserve_memory(full_resolution)({
+                'width': frames.size[0], 'height': frames.size[1], 'mode': 'RGBA', 'samples': a.multiframe_samples
+            })
+            state['samples'], scale = a.sample_frames(frames)
+            image = state['samples'][0]
+        elif full_resolution:
+            # Formats draft() can't shrink are decoded at full size here anyway; the composite reuses that
+            image, scale, state['full_image'] = a.decode_image(
+                image_data, a.analysis_max_size, max_pixels, keep_full=True
+            )
+        else:
+            image, scale = a.decode_image(image_data, a.analysis_max_size, max_pixels)
+        state.update(
+            image_data=image_data, image=image, scale=scale,
+            content_hash=hashlib.sha256(image_data).hexdigest()
+        )
+        
+        # Wait for the logos; failures fall through to get_logo_dimensions' own fallbacks
+        for future in logo_futures:
+            future.exception()
+        
+        # Logo size relative to the full-resolution image, snapped to a pre-rendered atlas size
+        if 'logo_size' not in state:
+            full_size = (round(image.shape[1] * scale), round(image.shape[0] * scale))
+            state['logo_size'] = a.get_logo_dimensions(dark_logo_url, light_logo_url, full_size)
+    
+    def features(self, state):
+        """Text detection and whole-frame feature tables, shared by every corner"""
+        a = self.analyzer
+        if state.get('samples'):
+            # One set of detections and averaged tables for the whole sequence
+            state['text_detections'], state['features'] = a.extract_sampled_features(
+                state.pop('samples'), state.get('text_detector')
+            )
+            return
+        state['text_detections'] = a.detect_text(state['image'], state.get('text_detector'))
+        state['features'] = a.extract_features(state['image'], state['text_detections'])
+    
+    def score(self, state):
+        """Score every corner concurrently on the shared pool, results in corner order"""
+        a = self.analyzer
+        logo_width, logo_height = state['logo_size']
+        futures = [
+            a.corner_pool.submit(
+                run_in_context(a.analyze_corner_space), state['image'], corner, logo_width, logo_height,
+                state['text_detections'], state['features'], state.get('scale', 1.0)
+            )
+            for corner in state['corners']
+        ]
+        state['corner_results'] = [future.result() for future in futures]
+    
+    def select(self, state):
+        """Rank corners with the corner bias, apply the acceptance thresholds and pick a logo variant"""
+        a = self.analyzer
+        logo_width, logo_height = state['logo_size']
+        best_corner = a.rank_corners(state['corner_results'])
+        state['best_corner'] = best_corner
+        result = {
+            'status': 'failed',
+            'reason': None,
+            'placement': None,
+            'selected_logo': None
+        }
+        state['result'] = result
+        
+        if not best_corner:
+            result['reason'] = 'No corners found suitable for logo placement'
+            failure = 'no_corner'
+        elif not best_corner['space_sufficient']:
+            result['reason'] = f"Insufficient space in best corner ({best_corner['corner']}). Available: {best_corner['available_width']}x{best_corner['available_height']}, Required: {logo_width}x{logo_height}"
+            failure = 'insufficient_space'
+        elif best_corner['suitability'] < 0.3:  # Low confidence threshold
+            result['reason'] = f"Low placement confidence ({best_corner['suitability']:.2f}) in best corner ({best_corner['corner']}). May have text or visual conflicts."
+            failure = 'low_confidence'
+        else:
+            failure = None
+        if failure:
+            a.metrics.inc('failures', failure)
+            state['done'] = True
+            return
+        
+        # Select logo variant based on available logos
+        dark_logo_url, light_logo_url = state.get('logo_urls', (None, None))
+        if dark_logo_url and light_logo_url:
+            # Both logos available - choose based on contrast, from the brightness the feature
+            # pass measured under the placement (re-measured on the working copy for older cache entries)
+            scale = state.get('scale', 1.0)
+            logo_selection = a.select_logo_variant(
+                state['image'],
+                round(best_corner['placement_x'] / scale),
+                round(best_corner['placement_y'] / scale),
+                max(1, round(logo_width / scale)),
+                max(1, round(logo_height / scale)),
+                best_corner.get('placement_brightness')
+            )
+            selected_logo_url = dark_logo_url if logo_selection['use_dark_logo'] else light_logo_url
+        else:
+            # Only one logo (or none, for placement-only analysis)
+            selected_logo_url = dark_logo_url or light_logo_url
+        
+        result.update({
+            'status': 'successful',
+            'placement': {
+                'corner': best_corner['corner'],
+                'x': best_corner['placement_x'],
+                'y': best_corner['placement_y'],
+                'width': logo_width,
+                'height': logo_height
+            },
+            'selected_logo': selected_logo_url
+        })
+        if state.get('frames'):
+            result['frames'] = state['frames'].count
+    
+    def composite(self, state):
+        """Blend the selected logo into the full-resolution image, or lazily into every frame of a sequence"""
+        a = self.analyzer
+        placement = state['result']['placement']
+        if state.get('frames'):
+            # Same placement in every frame; frames are decoded and blended as the encoder asks for them
+            state['composite_frames'] = (
+                a.create_logo_composite(
+                    frame, state['result']['selected_logo'],
+                    placement['x'], placement['y'], placement['width'], placement['height']
+                )
+                for frame in state['frames'].frames()
+            )
+            return
+        image = state['image']
+        # Full-resolution pixels are only decoded for compositing, unless decode already had them
+        if state.get('full_image') is not None:
+            image = state.pop('full_image')
+        elif state.get('scale', 1.0) != 1.0:
+            image = a.decode_image(state['image_data'], max_pixels=a.max_image_pixels)[0]
+        state['composite_image'] = a.create_logo_composite(
+            image, state['result']['selected_logo'],
+            placement['x'], placement['y'], placement['width'], placement['height']
+        )
+    
+    def encode(self, state):
+        """Encode once, in the source format unless the request asks otherwise (sequences keep their container)"""
+        a = self.analyzer
+        if state.get('frames'):
+            state['encoded'] = a.encode_frames(state['frames'], state['composite_frames'], state.get('output'))
+            return
+        state['encoded'] = a.encode_image(state['composite_image'], state.get('output'), a.source_format(state['image_data']))
+    
+    def store(self, state):
+        """Return the composite inline or store it (S3, else local), then delete the original"""
+        a = self.analyzer
+        result = state['result']
+        source = state['source']
+        encoded = state.get('encoded')
+        delete_original = state.get('delete_original', False)
+        
+        if encoded is not None:
+            if state.get('inline'):
+                # The response is the only copy, so the original is kept
+                result['output_image_data'] = encoded['data'].tobytes()
+                result['output_content_type'] = encoded['content_type']
+                delete_original = False
+            elif state.get('upload_to_s3'):
+                # Uploaded bytes have no original location to write beside
+                s3_url = a.upload_to_s3(encoded, source) if isinstance(source, str) else None
+                if s3_url:
+                    result['output_image'] = s3_url
+                else:
+                    # S3 failed, fallback to local file and keep the original; the spool retries the upload
+                    retry_url = source if isinstance(source, str) and all(a.parse_s3_url(source)) else None
+                    result['output_image'] = a.save_local_output(encoded, retry_url)
+                    delete_original = False
+            else:
+                # Force local storage
+                result['output_image'] = a.save_local_output(encoded)
+        
+        # Delete original S3 image if requested, once the upload has succeeded. The delete pool
+        # retries it with backoff; waiting for the outcome keeps original_deleted accurate for the
+        # response and for async jobs, whose result is recorded after this returns
+        delete = a.schedule_original_delete(source) if delete_original and isinstance(source, str) else None
+        result['original_deleted'] = delete.result() if delete is not None else False
+
 class LogoPlacementAnalyzer:
     def __init__(self):
         self.min_margin = 12  # Minimum 12px margin on each side
         self.preferred_margin = 25  # Preferred 25px margin on each side
+        # Download ceilings: bytes read, and decoded pixels allowed at full resolution
+        self.max_image_bytes = int(os.environ.get('IMAGE_MAX_BYTES', 40 * 1024 * 1024))
+        self.max_image_pixels = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+        # Local paths are only read from under this directory; unset disables local file input
+        local_root = os.environ.get('LOCAL_INPUT_ROOT')
+        self.local_input_root = os.path.realpath(local_root) if local_root else None
+        # Output encoding defaults; requests can override any of them
+        self.output_defaults = {
+            'format': os.environ.get('OUTPUT_FORMAT', 'source'),  # 'source' keeps the input's format
+            'jpeg_quality': int(os.environ.get('OUTPUT_JPEG_QUALITY', 90)),
+            'webp_quality': int(os.environ.get('OUTPUT_WEBP_QUALITY', 90)),
+            'png_compression': int(os.environ.get('OUTPUT_PNG_COMPRESSION', 1)),  # zlib level; 1 is OpenCV's default
+            'optimize': os.environ.get('OUTPUT_OPTIMIZE', 'false').lower() == 'true'
+        }
+        # Longest edge corners are scored at; compositing still uses the full-resolution image (0 = off)
+        self.analysis_max_size = int(os.environ.get('ANALYSIS_MAX_SIZE', 1600))
+        # Animated images and videos: frames sampled for scoring, and the most frames accepted
+        self.multiframe_samples = int(os.environ.get('MULTIFRAME_SAMPLES', 8))
+        self.multiframe_max_frames = int(os.environ.get('MULTIFRAME_MAX_FRAMES', 1800))
+        self.text_coverage_saturation = 0.05  # Text covering this share of a corner gets the full penalty
+        # 'sliding' searches each corner band for the least cluttered spot; 'fixed' pins at preferred_margin
+        self.placement_mode = os.environ.get('PLACEMENT_MODE', 'sliding')
+        self.text_clutter_weight = 4.0  # Text pixels under the logo cost this many edge pixels
+        self.placement_distance_weight = 0.05  # Pull toward the corner so equal-clutter spots stay tucked in
+        # Suitability multipliers favouring bottom corners (bottom-right most preferred)
+        self.corner_bias = {'bottom-right': 1.25, 'bottom-left': 1.15, 'top-right': 1.05, 'top-left': 1.0}
+        # Text detector backends are built once and shared across requests
+        self.text_detectors = {
+            'mser': MserTextDetector(),
+            'tesseract': TesseractTextDetector(max_size=int(os.environ.get('OCR_MAX_SIZE', 2000)))
+        }
+        self.default_text_detector = os.environ.get('TEXT_DETECTOR', 'mser')
+        if self.default_text_detector not in self.text_detectors:
+            raise ValueError(f"Unknown TEXT_DETECTOR: {self.default_text_detector}")
+        if self.placement_mode not in ('sliding', 'fixed'):
+            raise ValueError(f"Unknown PLACEMENT_MODE: {self.placement_mode}")
+        self.build_pools()
+        self.batch_max_images = int(os.environ.get('BATCH_MAX_IMAGES', 500))
+        # Caps text detection running at once across all requests (bounds Tesseract forks)
+        self.ocr_semaphore = threading.BoundedSemaphore(int(os.environ.get('OCR_MAX_CONCURRENCY', 4)))
+        # Stage timings and failure counts, shared across gunicorn workers
+        self.metrics = Metrics(slots=int(os.environ.get('METRICS_WORKER_SLOTS', 64)))
+        # Per-process cap on concurrent placements by count and estimated memory
+        self.admission = AdmissionController(
+            max_inflight=int(os.environ.get('ADMISSION_MAX_INFLIGHT', 4)),
+            max_memory=int(os.environ.get('ADMISSION_MAX_MEMORY_MB', 2048)) * 1024 * 1024,
+            max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 8)),
+            queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+            metrics=self.metrics
+        )
+        # boto3 and HTTP clients hold sockets, so each process builds its own on first use
+        self._s3_client = None
+        self._http = None
+        self._clients_lock = threading.Lock()
+        # Multipart above the threshold, parts uploaded in parallel
+        self.s3_transfer_config = TransferConfig(
+            multipart_threshold=int(os.environ.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)),
+            multipart_chunksize=int(os.environ.get('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024)),
+            max_concurrency=int(os.environ.get('S3_MAX_CONCURRENCY', 4))
+        )
+        self.delete_retries = int(os.environ.get('S3_DELETE_RETRIES', 5))
+        # Local composites (S3 fallback or upload_to_s3=false), written and evicted in the background
+        self.spool = OutputSpool(
+            os.path.join(APP_DIR, os.environ.get('OUTPUT_SPOOL_DIR', 'outputs')),
+            max_bytes=int(os.environ.get('OUTPUT_SPOOL_MAX_MB', 2048)) * 1024 * 1024,
+            ttl=int(os.environ.get('OUTPUT_SPOOL_TTL', 24 * 3600)),
+            sweep_interval=int(os.environ.get('OUTPUT_SPOOL_SWEEP_INTERVAL', 60)),
+            claim_timeout=int(os.environ.get('OUTPUT_SPOOL_CLAIM_TIMEOUT', 900)),
+            metrics=self.metrics
+        )
+        self.spool.uploader = self.upload_to_s3
+        # Per-corner scores for images we've already analysed (survives restarts)
+        self.placement_cache = PlacementCache(
+            os.path.join(APP_DIR, os.environ.get('PLACEMENT_CACHE_PATH', 'placement_cache.db')),
+            max_entries=int(os.environ.get('PLACEMENT_CACHE_MAX_ENTRIES', 100000))
+        )
+        # Shared by get_logo_dimensions and create_logo_composite
+        atlas_sizes = os.environ.get('LOGO_ATLAS_SIZES')
+        self.logo_cache = LogoCache(
+            max_entries=int(os.environ.get('LOGO_CACHE_MAX_ENTRIES', 512)),
+            ttl=int(os.environ.get('LOGO_CACHE_TTL', 3600)),
+            session=lambda: self.http,
+            sizes=[int(size) for size in atlas_sizes.split(',')] if atlas_sizes else LOGO_ATLAS_SIZES
+        )
+        # Logo long edge as a fraction of the image's short edge (0 = place at the logo's native size)
+        self.logo_size = float(os.environ.get('LOGO_SIZE', 0.2))
+        # Every entry point runs (part of) the same staged pipeline; repeat images reuse their scores
+        self.pipeline = PlacementPipeline(self)
+        self.pipeline.add_hook(self.placement_cache_hook)
+    
+    def build_pools(self):
+        """Thread pools; threads don't survive fork, so workers rebuild these after forking"""
+        # Process-wide pool for corner analysis; Canny and Tesseract release the GIL
+        self.corner_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('CORNER_POOL_WORKERS', os.cpu_count() or 4)),
+            thread_name_prefix='corner'
+        )
+        # Separate pool for batch items so they never wait on the corner pool they feed
+        self.batch_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('BATCH_POOL_WORKERS', 4)),
+            thread_name_prefix='batch'
+        )
+        # Original deletes run off the request thread, retried with backoff
+        self.delete_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('S3_DELETE_WORKERS', 2)),
+            thread_name_prefix='s3-delete'
+        )
+        # Image and logo downloads for one request run side by side
+        self.fetch_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('HTTP_FETCH_WORKERS', 8)),
+            thread_name_prefix='fetch'
+        )
+    
+    def after_fork(self, metrics_slot=None):
+        """Reset per-process state in a freshly forked worker; models and caches stay shared"""
+        self.build_pools()
+        self.metrics.after_fork(metrics_slot)
+        self.admission.after_fork()
+        self.spool.after_fork()
+        self._clients_lock = threading.Lock()
+        self._s3_client = None
+        self._http = None
+    
+    def shutdown(self, wait=True):
+        """Stop accepting pool work, letting queued original deletes and spool writes finish when wait is set"""
+        for pool in (self.batch_pool, self.corner_pool, self.fetch_pool, self.delete_pool):
+            pool.shutdown(wait=wait)
+        self.spool.shutdown(wait=wait)
+    
+    @property
+    def s3_client(self):
         # Use BuyLocalNZ profile from ~/.aws/credentials
-        session = boto3.Session(profile_name='BuyLocalNZ')
-        self.s3_client = session.client('s3')
+        if self._s3_client is None:
+            with self._clients_lock:
+                if self._s3_client is None:
+                    self._s3_client = self.build_s3_client()
+        return self._s3_client
+    
+    @property
+    def http(self):
+        # Keep-alive connection pools to the image/logo CDNs, shared by every download
+        if self._http is None:
+            with self._clients_lock:
+                if self._http is None:
+                    self._http = self.build_http_session()
+        return self._http
+    
+    def preload_logos(self, urls):
+        """Warm the logo cache and render its atlas (e.g. in the master before fork) so workers share it"""
+        loaded = 0
+        for url in urls:
+            try:
+                self.logo_cache.prerender(url)
+                loaded += 1
+            except Exception as e:
+                print(f"Logo preload failed for {url}: {e}")
+        return loaded
+    
+    def build_s3_client(self):
+        """S3 client with a tuned connection pool; S3_ENDPOINT_URL points it at MinIO or moto for testing"""
+        profile = os.environ.get('S3_PROFILE', 'BuyLocalNZ')
+        session = boto3.Session(profile_name=profile) if profile else boto3.Session()
+        config = Config(
+            max_pool_connections=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50)),
+            retries={'max_attempts': int(os.environ.get('S3_MAX_ATTEMPTS', 5)), 'mode': 'standard'},
+            tcp_keepalive=True
+        )
+        return session.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None, config=config)
+    
+    def build_http_session(self):
+        """Connection-pooled HTTP session with retry and backoff on transient failures"""
+        retry = Retry(
+            total=int(os.environ.get('HTTP_RETRIES', 3)),
+            backoff_factor=float(os.environ.get('HTTP_BACKOFF', 0.3)),
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET', 'HEAD']
+        )
+        adapter = HTTPAdapter(
+            pool_connections=int(os.environ.get('HTTP_POOL_CONNECTIONS', 16)),  # Hosts kept pooled
+            pool_maxsize=int(os.environ.get('HTTP_POOL_MAXSIZE', 32)),  # Keep-alive connections per host
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    def http_stats(self):
+        """Per-host request and new-connection counts for the pooled HTTP session"""
+        stats = {}
+        for adapter in set(self.http.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.scheme}://{pool.host}:{pool.port}" if pool.port else f"{pool.scheme}://{pool.host}"
+                host_stats = stats.setdefault(host, {'requests': 0, 'connections': 0})
+                host_stats['requests'] += pool.num_requests
+                host_stats['connections'] += pool.num_connections
+        for host_stats in stats.values():
+            host_stats['reused'] = max(0, host_stats['requests'] - host_stats['connections'])
+        return stats
+        
+    def download_image(self, url):
+        """Download image from URL (or any fetch_image source) and return as numpy array"""
+        return self.decode_image(self.fetch_image(url, self.max_image_pixels), max_pixels=self.max_image_pixels)[0]
+    
+    def fetch_image(self, source, max_pixels=None, on_header=None, downscaled=False):
+        """Read image bytes from an HTTP(S) URL, s3:// URI, local path or raw bytes
+        
+        Every source goes through the same byte ceiling and early header check. With
+        downscaled, only a working copy will be decoded (see read_image_stream).
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            label = 'uploaded image'
+        else:
+            label = source
+        try:
+            with self.metrics.span('download'):
+                if isinstance(source, (bytes, bytearray, memoryview)):
+                    data = bytes(source)
+                    return self.read_image_stream([data], len(data), max_pixels, on_header, downscaled)
+                
+                if source.startswith('s3://'):
+                    # Straight from the bucket with our credentials; no public URL or extra hop
+                    bucket, key = self.parse_s3_url(source)
+                    response = self.s3_client.get_object(Bucket=bucket, Key=key)
+                    with closing(response['Body']) as body:
+                        return self.read_image_stream(
+                            body.iter_chunks(64 * 1024), response.get('ContentLength'), max_pixels, on_header, downscaled
+                        )
+                
+                if source.startswith(('http://', 'https://')):
+                    with self.http.get(source, timeout=10, stream=True) as response:
+                        response.raise_for_status()
+                        return self.read_image_stream(
+                            response.iter_content(chunk_size=64 * 1024),
+                            response.headers.get('Content-Length'), max_pixels, on_header, downscaled
+                        )
+                
+                with open(self.local_input_path(source), 'rb') as f:
+                    return self.read_image_stream(
+                        iter(lambda: f.read(64 * 1024), b''), os.fstat(f.fileno()).st_size, max_pixels, on_header, downscaled
+                    )
+        except OverloadedError:
+            raise  # Raised by the header check's memory reservation
+        except ImageTooLargeError as e:
+            raise ImageTooLargeError(f"Failed to download image from {label}: {str(e)}")
+        except Exception as e:
+            raise DownloadError(f"Failed to download image from {label}: {str(e)}")
+    
+    def local_input_path(self, source):
+        """Resolve a local path (or file:// URL), which must sit under LOCAL_INPUT_ROOT"""
+        if not self.local_input_root:
+            raise ValueError("Local file input is disabled (set LOCAL_INPUT_ROOT)")
+        path = os.path.realpath(source[len('file://'):] if source.startswith('file://') else source)
+        if os.path.commonpath([path, self.local_input_root]) != self.local_input_root:
+            raise ValueError(f"Path is outside LOCAL_INPUT_ROOT: {source}")
+        return path
+    
+    def read_image_stream(self, chunks, declared, max_pixels=None, on_header=None, downscaled=False):
+        """Collect image chunks, enforcing the byte ceiling and checking the header early
+        
+        With downscaled, a JPEG is held to the pixel ceiling at the 1/8 scale libjpeg can
+        decode it at (decode_image checks the size it really decodes at); other formats
+        are decoded at full size first, so the ceiling applies to them as it stands.
+        """
+        if declared and int(declared) > self.max_image_bytes:
+            raise ImageTooLargeError(f"Image is {declared} bytes (max {self.max_image_bytes})")
+        
+        buffer = io.BytesIO()
+        parser = ImageFile.Parser()
+        for chunk in chunks:
+            buffer.write(chunk)
+            if buffer.tell() > self.max_image_bytes:
+                raise ImageTooLargeError(f"Image exceeds {self.max_image_bytes} bytes")
+            
+            # Inspect format/dimensions as soon as the header has arrived, before reading the rest
+            if parser is not None:
+                try:
+                    parser.feed(chunk)
+                except Exception:
+                    parser = None  # Unparseable header; decode_image reports the real error
+                    continue
+                if parser.image is not None:
+                    header = {
+                        'format': parser.image.format,
+                        'width': parser.image.size[0],
+                        'height': parser.image.size[1],
+                        'mode': parser.image.mode
+                    }
+                    parser = None
+                    pixels = header['width'] * header['height']
+                    if downscaled and header['format'] in DRAFT_FORMATS:
+                        pixels //= 64
+                    if max_pixels and pixels > max_pixels:
+                        raise ImageTooLargeError(f"Image is {header['width']}x{header['height']} (max {max_pixels} pixels)")
+                    if on_header:
+                        on_header(header)
+                elif buffer.tell() > 1024 * 1024:
+                    parser = None  # Header not found in the first 1MB; stop looking
+        
+        return buffer.getvalue()
+    
+    def estimate_memory(self, header, full_resolution=True):
+        """Rough peak working memory in bytes for an image with this header's dimensions"""
+        width, height = header['width'], header['height']
+        channels = 4 if 'A' in header['mode'] else 3
+        ratio = min(1.0, self.analysis_max_size / max(width, height)) if self.analysis_max_size else 1.0
+        # Working copy, gray/edge/text maps and five 8-byte summed-area tables. A frame sequence
+        # holds a working copy per sampled frame and a running average of the tables as well.
+        samples = header.get('samples', 1)
+        estimate = width * height * ratio * ratio * (channels * samples + 3 + 5 * 8 * min(samples, 2))
+        if header.get('format') not in DRAFT_FORMATS:
+            # No decode-time downscale: the decoder builds the full-resolution buffer before the
+            # working copy is reduced from it (PIL keeps RGB at 4 bytes a pixel)
+            estimate += width * height * 4
+        if full_resolution:
+            # Full-resolution decode, composite copy and encode buffer
+            estimate += width * height * channels * 3
+        return int(estimate)
+    
+    def reserve_memory(self, full_resolution=True):
+        """fetch_image on_header callback reserving the image's memory with admission control"""
+        return lambda header: self.admission.reserve(self.estimate_memory(header, full_resolution))
+    
+    def decode_image(self, data, max_size=None, max_pixels=None, keep_full=False):
+        """Decode image bytes to (numpy array, scale), downscaling so the longest edge fits max_size
+        
+        With keep_full, returns (array, scale, full) where full is the full-resolution array
+        when the decoder had to build it anyway (no draft() support), else None.
+        """
+        try:
+            with self.metrics.span('decode' if max_size else 'decode_full'):
+                decoded = self._decode_image(data, max_size, max_pixels, keep_full)
+                return decoded if keep_full else decoded[:2]
+        except ImageTooLargeError as e:
+            raise ImageTooLargeError(f"Failed to decode image: {str(e)}")
+        except Exception as e:
+            raise DecodeError(f"Failed to decode image: {str(e)}")
+    
+    def _decode_image(self, data, max_size, max_pixels, keep_full=False):
+        image = Image.open(io.BytesIO(data))
+        full_w, full_h = image.size
         
-    def download_image(self, url):
-        """Download image from URL and return as numpy array"""
+        if max_size and max(full_w, full_h) > max_size:
+            target = working_size(full_w, full_h, max_size)
+            # JPEG: let libjpeg decode at 1/2, 1/4 or 1/8 scale, never building the full buffer
+            image.draft(image.mode, target)
+        
+        # Refuse to materialise a buffer past the pixel ceiling; draft() is the only thing
+        # that shrinks what the decoder builds, so other formats are checked at full size
+        if max_pixels and image.size[0] * image.size[1] > max_pixels:
+            raise ImageTooLargeError(f"Image is {full_w}x{full_h} (max {max_pixels} pixels)")
+        
+        full = None
+        if max_size and max(full_w, full_h) > max_size:
+            if keep_full and image.size == (full_w, full_h):
+                # draft() couldn't shrink it, so this is a full decode; keep it for compositing
+                full = pil_to_array(image)
+            # Other formats (or what draft left over): cheap box reduce, then exact resize
+            factor = min(image.size[0] // target[0], image.size[1] // target[1])
+            if factor >= 2:
+                image = image.reduce(factor)
+            if image.size != target:
+                image = image.resize(target, Image.BILINEAR)
+        
+        return pil_to_array(image), full_w / image.size[0], full
+    
+    def open_frames(self, data):
+        """Frame source for an animated GIF/WebP, multi-page TIFF or video, or None for a still image
+        
+        Video headers aren't checked while downloading, so frame size and count are checked here.
+        """
+        container = video_container(data)
+        if container:
+            try:
+                frames = VideoFrames(data, container)
+            except Exception as e:
+                raise DecodeError(f"Failed to decode video: {str(e)}")
+        else:
+            try:
+                image = Image.open(io.BytesIO(data))
+            except Exception:
+                return None  # decode_image reports the real error
+            if image.format not in AnimatedFrames.FORMATS or getattr(image, 'n_frames', 1) < 2:
+                return None
+            frames = AnimatedFrames(image)
+        
+        width, height = frames.size
+        if width * height > self.max_image_pixels or frames.count > self.multiframe_max_frames:
+            frames.close()
+            raise ImageTooLargeError(
+                f"Sequence is {frames.count} frames of {width}x{height} "
+                f"(max {self.multiframe_max_frames} frames, {self.max_image_pixels} pixels)"
+            )
+        return frames
+    
+    def sample_frames(self, frames):
+        """Working copies of frames spread across the sequence, and their scale to full resolution"""
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            image = Image.open(io.BytesIO(response.content))
-            return np.array(image)
+            with self.metrics.span('decode'):
+                samples = frames.sample(self.multiframe_samples, self.analysis_max_size)
         except Exception as e:
-            raise ValueError(f"Failed to download image from {url}: {str(e)}")
+            raise DecodeError(f"Failed to decode frames: {str(e)}")
+        return samples, frames.size[0] / samples[0].shape[1]
     
-    def analyze_corner_space(self, image, corner, logo_width=100, logo_height=50):
-        """Analyze available space in a specific corner"""
+    def get_corner_regions(self, image):
+        """Return (x1, y1, x2, y2) of each corner region (outer thirds of the image)"""
         h, w = image.shape[:2]
-        
-        # Define corner regions
-        corners = {
+        return {
             'top-left': (0, 0, w//3, h//3),
             'top-right': (w*2//3, 0, w, h//3),
             'bottom-left': (0, h*2//3, w//3, h),
             'bottom-right': (w*2//3, h*2//3, w, h)
         }
+    
+    def build_corner_mosaic(self, image, regions, gutter=20):
+        """Tile the four grayscale corner regions into one 2x2 mosaic for a single OCR pass"""
+        gray = to_gray(image)
+        order = [['top-left', 'top-right'], ['bottom-left', 'bottom-right']]
+        
+        col_w = [max(regions[row[c]][2] - regions[row[c]][0] for row in order) for c in range(2)]
+        row_h = [max(regions[name][3] - regions[name][1] for name in row) for row in order]
+        
+        # White gutters stop Tesseract joining words across neighbouring tiles
+        mosaic = np.full((sum(row_h) + 3 * gutter, sum(col_w) + 3 * gutter), 255, dtype=np.uint8)
+        offsets = {}
+        oy = gutter
+        for r, row in enumerate(order):
+            ox = gutter
+            for c, name in enumerate(row):
+                x1, y1, x2, y2 = regions[name]
+                mosaic[oy:oy + (y2 - y1), ox:ox + (x2 - x1)] = gray[y1:y2, x1:x2]
+                offsets[name] = (ox, oy)
+                ox += col_w[c] + gutter
+            oy += row_h[r] + gutter
+        return mosaic, offsets
+    
+    def detect_text(self, image, text_detector=None):
+        """Run text detection once over all four corners and return boxes and coverage per corner"""
+        detector = self.text_detectors[text_detector or self.default_text_detector]
+        regions = self.get_corner_regions(image)
+        detections = {
+            corner: {'has_text': False, 'text_boxes': [], 'text_coverage': 0.0, 'detector': detector.name}
+            for corner in regions
+        }
+        
+        mosaic, offsets = self.build_corner_mosaic(image, regions)
+        
+        # Downscale very large mosaics so one detection pass stays cheap
+        scale = min(1.0, detector.max_size / max(mosaic.shape[:2]))
+        if scale < 1.0:
+            mosaic = cv2.resize(mosaic, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        try:
+            with self.ocr_semaphore, self.metrics.span('text_detection'):
+                boxes = detector.detect(mosaic)
+        except Exception as e:
+            print(f"Text detection error ({detector.name}): {e}")
+            return detections
+        
+        for left, top, width, height, confidence, text in boxes:
+            # Map box back to full-resolution mosaic coordinates
+            bx = left / scale
+            by = top / scale
+            bw = width / scale
+            bh = height / scale
+            cx, cy = bx + bw / 2, by + bh / 2
+            
+            # Assign box to the tile containing its centre, then to image coordinates
+            for corner, (ox, oy) in offsets.items():
+                x1, y1, x2, y2 = regions[corner]
+                if ox <= cx < ox + (x2 - x1) and oy <= cy < oy + (y2 - y1):
+                    detections[corner]['text_boxes'].append({
+                        'x': int(x1 + bx - ox),
+                        'y': int(y1 + by - oy),
+                        'width': int(bw),
+                        'height': int(bh),
+                        'confidence': confidence,
+                        'text': text
+                    })
+                    detections[corner]['has_text'] = True
+                    break
+        
+        # Share of each corner region covered by text (overlapping boxes counted once)
+        for corner, detection in detections.items():
+            if not detection['text_boxes']:
+                continue
+            x1, y1, x2, y2 = regions[corner]
+            covered = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+            for box in detection['text_boxes']:
+                bx, by = box['x'] - x1, box['y'] - y1
+                covered[max(0, by):by + box['height'], max(0, bx):bx + box['width']] = True
+            detection['text_coverage'] = float(covered.mean())
+        
+        return detections
+    
+    @timed('features')
+    def extract_features(self, image, text_detections):
+        """One grayscale and one Canny pass over the frame, as summed-area tables plus per-corner stats
+        
+        Every later lookup (corner statistics, sliding placement clutter, brightness under
+        the logo) is an O(1) table read instead of another pass over pixels.
+        """
+        gray = to_gray(image)
+        edges = (cv2.Canny(gray, 50, 150) > 0).astype(np.uint8)
+        # Local contrast: how far each pixel sits from its 9x9 neighbourhood mean (fine texture Canny misses)
+        contrast = cv2.absdiff(gray, cv2.blur(gray, (9, 9)))
+        
+        text_mask = np.zeros(gray.shape, dtype=np.uint8)
+        for detection in text_detections.values():
+            for box in detection['text_boxes']:
+                text_mask[max(0, box['y']):box['y'] + box['height'], max(0, box['x']):box['x'] + box['width']] = 1
+        
+        gray_sum, gray_sqsum = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        features = {
+            'edges': cv2.integral(edges),
+            'text': cv2.integral(text_mask),
+            'gray': gray_sum,
+            'gray_sq': gray_sqsum,
+            'contrast': cv2.integral(contrast, sdepth=cv2.CV_64F)
+        }
+        
+        # All four corners at once
+        regions = self.get_corner_regions(image)
+        x1, y1, x2, y2 = (np.array(values) for values in zip(*regions.values()))
+        area = np.maximum(1, (x2 - x1) * (y2 - y1))
+        brightness = rect_sums(gray_sum, x1, y1, x2, y2) / area
+        variance = np.maximum(0.0, rect_sums(gray_sqsum, x1, y1, x2, y2) / area - brightness ** 2)
+        edge_density = rect_sums(features['edges'], x1, y1, x2, y2) / area
+        local_contrast = rect_sums(features['contrast'], x1, y1, x2, y2) / area
+        features['corners'] = {
+            corner: {
+                'edge_density': float(edge_density[i]),
+                'brightness': float(brightness[i]),
+                'variance': float(variance[i]),
+                'local_contrast': float(local_contrast[i])
+            }
+            for i, corner in enumerate(regions)
+        }
+        return features
+    
+    def extract_sampled_features(self, samples, text_detector=None):
+        """Text detections and feature tables for a frame sequence, from its sampled frames
+        
+        Text found in any sample counts in every frame and the tables are averaged over
+        the samples, so the sequence gets one placement: a spot that is busy for part of
+        the clip scores as partly cluttered rather than flipping between corners.
+        """
+        futures = [
+            self.corner_pool.submit(run_in_context(self.detect_text), sample, text_detector)
+            for sample in samples
+        ]
+        per_frame = [future.result() for future in futures]
+        detections = {
+            corner: {
+                'has_text': any(frame[corner]['has_text'] for frame in per_frame),
+                'text_boxes': [box for frame in per_frame for box in frame[corner]['text_boxes']],
+                'text_coverage': max(frame[corner]['text_coverage'] for frame in per_frame),  # Busiest frame
+                'detector': per_frame[0][corner]['detector']
+            }
+            for corner in per_frame[0]
+        }
+        
+        # Running sums, so only one sample's tables exist at a time besides the averages
+        features, corner_stats = {}, []
+        for sample in samples:
+            frame_features = self.extract_features(sample, detections)
+            corner_stats.append(frame_features.pop('corners'))
+            for key, table in frame_features.items():
+                if key in features:
+                    features[key] += table
+                else:
+                    features[key] = table.astype(np.float64)
+        for table in features.values():
+            table /= len(samples)
+        features['corners'] = {
+            corner: {stat: float(np.mean([frame[corner][stat] for frame in corner_stats])) for stat in stats}
+            for corner, stats in corner_stats[0].items()
+        }
+        return detections, features
+    
+    def find_placement(self, image, corner, logo_width, logo_height, features, scale=1.0):
+        """Slide the logo over a corner band and return the least cluttered position (working-image pixels)"""
+        h, w = image.shape[:2]
+        x1, y1, x2, y2 = self.get_corner_regions(image)[corner]
+        area = logo_width * logo_height
+        step = max(1, min(logo_width, logo_height) // 8)
+        
+        # Keep preferred_margin from the image edges when the band allows it, else fall back to min_margin
+        for margin in (round(self.preferred_margin / scale), round(self.min_margin / scale)):
+            x_lo, x_hi = max(x1, margin), min(x2, w - margin) - logo_width
+            y_lo, y_hi = max(y1, margin), min(y2, h - margin) - logo_height
+            if x_hi < x_lo or y_hi < y_lo:
+                continue
+            
+            xs = np.unique(np.append(np.arange(x_lo, x_hi + 1, step), x_hi))
+            ys = np.unique(np.append(np.arange(y_lo, y_hi + 1, step), y_hi))
+            
+            edge_fraction = window_sums(features['edges'], xs, ys, logo_width, logo_height) / area
+            text_fraction = window_sums(features['text'], xs, ys, logo_width, logo_height) / area
+            clutter = edge_fraction + self.text_clutter_weight * text_fraction
+            
+            # Distance from the position pinned into the corner, as a fraction of the image
+            anchor_x = margin if corner.endswith('left') else w - margin - logo_width
+            anchor_y = margin if corner.startswith('top') else h - margin - logo_height
+            distance = np.hypot((ys[:, None] - anchor_y) / h, (xs[None, :] - anchor_x) / w)
+            
+            cost = clutter + self.placement_distance_weight * distance
+            iy, ix = np.unravel_index(np.argmin(cost), cost.shape)
+            return {
+                'x': int(xs[ix]),
+                'y': int(ys[iy]),
+                'clutter': float(clutter[iy, ix]),
+                'margin': margin
+            }
+        
+        return None
+    
+    @timed('corner_analysis')
+    def analyze_corner_space(self, image, corner, logo_width=100, logo_height=50, text_detections=None, features=None, scale=1.0):
+        """Analyze available space in a specific corner"""
+        # image may be a downscaled working copy (scale = full / working size); logo size and
+        # returned coordinates are full resolution, so work in working pixels and map back on return
+        full_logo_width, full_logo_height = logo_width, logo_height
+        logo_width = max(1, round(logo_width / scale))
+        logo_height = max(1, round(logo_height / scale))
+        preferred_margin = round(self.preferred_margin / scale)
+        
+        # Define corner regions
+        corners = self.get_corner_regions(image)
         
         if corner not in corners:
             return None
             
         x1, y1, x2, y2 = corners[corner]
-        corner_region = image[y1:y2, x1:x2]
-        
-        # Convert to grayscale for analysis
-        gray = cv2.cvtColor(corner_region, cv2.COLOR_BGR2GRAY) if len(corner_region.shape) == 3 else corner_region
-        
-        # Detect text using OCR
-        try:
-            text = pytesseract.image_to_string(gray)
-            has_text = len(text.strip()) > 0
-        except:
-            has_text = False
         
-        # Detect edges (important visual elements)
-        edges = cv2.Canny(gray, 50, 150)
-        edge_density = np.sum(edges > 0) / (edges.shape[0] * edges.shape[1])
+        # Reuse the shared OCR and feature passes when the caller already ran them
+        if text_detections is None:
+            text_detections = self.detect_text(image)
+        if features is None:
+            features = self.extract_features(image, text_detections)
+        has_text = text_detections[corner]['has_text']
+        text_coverage = text_detections[corner]['text_coverage']
+        corner_features = features['corners'][corner]
+        edge_density = corner_features['edge_density']
         
         # Calculate available space based on corner
         if corner == 'top-left':
-            available_x = x2 - x1 - self.preferred_margin
-            available_y = y2 - y1 - self.preferred_margin
-            placement_x = self.preferred_margin
-            placement_y = self.preferred_margin
+            available_x = x2 - x1 - preferred_margin
+            available_y = y2 - y1 - preferred_margin
+            placement_x = preferred_margin
+            placement_y = preferred_margin
         elif corner == 'top-right':
-            available_x = x2 - x1 - self.preferred_margin
-            available_y = y2 - y1 - self.preferred_margin
+            available_x = x2 - x1 - preferred_margin
+            available_y = y2 - y1 - preferred_margin
             placement_x = x1 + available_x - logo_width
-            placement_y = self.preferred_margin
+            placement_y = preferred_margin
         elif corner == 'bottom-left':
-            available_x = x2 - x1 - self.preferred_margin
-            available_y = y2 - y1 - self.preferred_margin
-            placement_x = self.preferred_margin
+            available_x = x2 - x1 - preferred_margin
+            available_y = y2 - y1 - preferred_margin
+            placement_x = preferred_margin
             placement_y = y1 + available_y - logo_height
         else:  # bottom-right
-            available_x = x2 - x1 - self.preferred_margin
-            available_y = y2 - y1 - self.preferred_margin
+            available_x = x2 - x1 - preferred_margin
+            available_y = y2 - y1 - preferred_margin
             placement_x = x1 + available_x - logo_width
             placement_y = y1 + available_y - logo_height
         
         # Check if space is sufficient
         space_sufficient = available_x >= logo_width and available_y >= logo_height
         
+        # Move to the least cluttered spot in the corner band when sliding placement is on
+        placement_clutter = None
+        if self.placement_mode == 'sliding':
+            placement = self.find_placement(image, corner, logo_width, logo_height, features, scale)
+            if placement:
+                placement_x, placement_y = placement['x'], placement['y']
+                placement_clutter = placement['clutter']
+        
+        # Background brightness under the logo, for choosing the dark or light variant
+        placement_brightness = self.calculate_average_brightness(
+            image, placement_x, placement_y, logo_width, logo_height, features
+        )
+        
         # Calculate suitability score
         suitability = 1.0
         if has_text:
-            suitability *= 0.3  # Heavy penalty for text
+            # Penalty grows with text coverage, up to the old flat 0.3 multiplier
+            suitability *= 1 - 0.7 * min(1.0, text_coverage / self.text_coverage_saturation)
         if edge_density > 0.1:
             suitability *= (1 - edge_density)  # Penalty for high edge density
         if not space_sufficient:
             suitability *= 0.1  # Heavy penalty for insufficient space
             
+        # Map working-image coordinates back to full resolution, keeping the logo inside the frame
+        text_boxes = text_detections[corner]['text_boxes']
+        if scale != 1.0:
+            full_h, full_w = round(image.shape[0] * scale), round(image.shape[1] * scale)
+            placement_x = min(round(placement_x * scale), full_w - full_logo_width)
+            placement_y = min(round(placement_y * scale), full_h - full_logo_height)
+            text_boxes = [
+                {**box, 'x': round(box['x'] * scale), 'y': round(box['y'] * scale),
+                 'width': round(box['width'] * scale), 'height': round(box['height'] * scale)}
+                for box in text_boxes
+            ]
+            
         return {
             'corner': corner,
-            'available_width': available_x,
-            'available_height': available_y,
+            'available_width': round(available_x * scale),
+            'available_height': round(available_y * scale),
             'placement_x': int(placement_x),
             'placement_y': int(placement_y),
+            'placement_clutter': placement_clutter,
             'has_text': has_text,
+            'text_boxes': text_boxes,
+            'text_coverage': text_coverage,
             'edge_density': edge_density,
+            'brightness': corner_features['brightness'],
+            'variance': corner_features['variance'],
+            'local_contrast': corner_features['local_contrast'],
+            'placement_brightness': placement_brightness,
             'space_sufficient': space_sufficient,
             'suitability': suitability
         }
     
-    def find_best_corner(self, image, logo_width=100, logo_height=50):
+    def analyze_corners(self, image, corners, logo_width=100, logo_height=50, text_detector=None, scale=1.0, content_hash=None):
+        """Score corners of a decoded working copy (the pipeline's features and score stages), in input order"""
+        state = self.pipeline.run({
+            'image': image, 'scale': scale, 'corners': list(corners), 'logo_size': (logo_width, logo_height),
+            'text_detector': text_detector, 'content_hash': content_hash
+        }, stages=('features', 'score'))
+        return state['corner_results']
+    
+    @contextmanager
+    def placement_cache_hook(self, stage, state):
+        """Pipeline hook: a repeat image + logo size reuses its stored scores, skipping text detection and edges"""
+        if stage == 'features' and state.get('content_hash'):
+            state['cache_key'] = ':'.join([
+                state['content_hash'], '{}x{}'.format(*state['logo_size']),
+                state.get('text_detector') or self.default_text_detector,
+                self.placement_mode, str(self.analysis_max_size), ','.join(state['corners'])
+            ] + ([f"frames{self.multiframe_samples}"] if state.get('frames') else []))
+            cached = self.placement_cache.get(state['cache_key'])
+            if cached is not None:
+                state['corner_results'] = cached
+                state['skip'].update(('features', 'score'))
+        yield
+        if stage == 'score' and state.get('cache_key') and 'score' not in state['skip']:
+            self.placement_cache.put(state['cache_key'], state['corner_results'])
+    
+    def rank_corners(self, corner_results):
+        """Best corner after the corner bias, or None; the scored results themselves are left untouched"""
+        ranked = [
+            dict(result, suitability=result['suitability'] * self.corner_bias.get(result['corner'], 1.0))
+            for result in corner_results if result
+        ]
+        return max(ranked, key=lambda result: result['suitability'], default=None)
+    
+    def find_best_corner(self, image, logo_width=100, logo_height=50, text_detector=None):
         """Find the best corner for logo placement"""
-        corners = ['top-left', 'top-right', 'bottom-left', 'bottom-right']
-        results = []
-        
-        for corner in corners:
-            result = self.analyze_corner_space(image, corner, logo_width, logo_height)
-            if result:
-                # Add bias for bottom corners (prefer bottom over top)
-                if corner.startswith('bottom'):
-                    result['suitability'] *= 1.15  # 15% bonus for bottom corners
-                results.append(result)
-        
-        # Sort by suitability score
-        results.sort(key=lambda x: x['suitability'], reverse=True)
-        return results[0] if results else None
-    
-    def calculate_average_brightness(self, image, x, y, width, height):
-        """Calculate average brightness in a specific region"""
+        return self.rank_corners(self.analyze_corners(image, CORNERS, logo_width, logo_height, text_detector))
+    
+    def calculate_average_brightness(self, image, x, y, width, height, features=None):
+        """Calculate average brightness in a specific region (from the feature tables when given)"""
         h, w = image.shape[:2]
         x1 = max(0, x)
         y1 = max(0, y)
         x2 = min(w, x + width)
         y2 = min(h, y + height)
         
+        if features is not None:
+            return float(rect_sums(features['gray'], x1, y1, x2, y2) / max(1, (x2 - x1) * (y2 - y1)))
+        
         region = image[y1:y2, x1:x2]
         
         # Convert to grayscale
-        if len(region.shape) == 3:
-            gray = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = region
+        gray = to_gray(region)
             
-        return np.mean(gray)
+        return float(np.mean(gray))
     
-    def select_logo_variant(self, image, placement_x, placement_y, logo_width, logo_height):
-        """Select dark or light logo based on background brightness"""
-        brightness = self.calculate_average_brightness(
-            image, placement_x, placement_y, logo_width, logo_height
-        )
+    def select_logo_variant(self, image, placement_x, placement_y, logo_width, logo_height, brightness=None):
+        """Select dark or light logo based on background brightness (precomputed when given)"""
+        if brightness is None:
+            brightness = self.calculate_average_brightness(
+                image, placement_x, placement_y, logo_width, logo_height
+            )
         
         # If background is bright, use dark logo; if dark, use light logo
         use_dark_logo = brightness > 127
@@ -165,49 +2327,48 @@ class LogoPlacementAnalyzer:
             'contrast_ratio': brightness / 255 if use_dark_logo else (255 - brightness) / 255
         }
     
+    @timed('composite')
     def create_logo_composite(self, image, logo_url, placement_x, placement_y, logo_width, logo_height):
-        """Create composite image with logo placed"""
+        """Alpha-blend the logo into its target region of the image, in place"""
         try:
-            # Download logo
-            logo_response = requests.get(logo_url, timeout=10)
-            logo_response.raise_for_status()
-            
-            # Open logo directly with PIL to preserve quality and transparency
-            pil_logo = Image.open(io.BytesIO(logo_response.content))
-            
-            # Convert main image to PIL
-            pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            # Pre-rendered, premultiplied atlas entry fitted to the placement box; usually no resampling here
+            logo = self.logo_cache.get_render_within(logo_url, logo_width, logo_height)
             
-            # Get original logo dimensions
-            orig_logo_w, orig_logo_h = pil_logo.size
+            # Clip the logo rectangle to the image (negative offsets crop the logo, like PIL paste)
+            h, w = image.shape[:2]
+            lh, lw = logo.shape[:2]
+            x1, y1 = max(0, placement_x), max(0, placement_y)
+            x2, y2 = min(w, placement_x + lw), min(h, placement_y + lh)
+            if x2 <= x1 or y2 <= y1:
+                return image
+            logo = logo[y1 - placement_y:y2 - placement_y, x1 - placement_x:x2 - placement_x]
             
-            # Only resize if dimensions are different (preserve original quality)
-            if orig_logo_w != logo_width or orig_logo_h != logo_height:
-                # Maintain aspect ratio if it's significantly different
-                aspect_ratio = orig_logo_w / orig_logo_h
-                target_ratio = logo_width / logo_height
-                
-                if abs(aspect_ratio - target_ratio) > 0.1:  # More than 10% difference
-                    # Maintain aspect ratio, fit within target dimensions
-                    if aspect_ratio > target_ratio:
-                        new_w = logo_width
-                        new_h = int(logo_width / aspect_ratio)
-                    else:
-                        new_h = logo_height
-                        new_w = int(logo_height * aspect_ratio)
-                    pil_logo = pil_logo.resize((new_w, new_h), Image.LANCZOS)
-                else:
-                    # Aspect ratios are similar, safe to resize
-                    pil_logo = pil_logo.resize((logo_width, logo_height), Image.LANCZOS)
+            # Premultiplied logo colours in the image's channel layout (gray is linear, so it stays premultiplied)
+            channels = 1 if len(image.shape) == 2 else image.shape[2]
+            if channels == 1:
+                logo_color = cv2.cvtColor(logo[:, :, :3], cv2.COLOR_BGR2GRAY)
+            else:
+                logo_color = logo[:, :, :3]
+            alpha = logo[:, :, 3]
             
-            # Handle transparency properly
-            if pil_logo.mode in ('RGBA', 'LA'):
-                pil_image.paste(pil_logo, (placement_x, placement_y), pil_logo)
+            roi = image[y1:y2, x1:x2]
+            color_roi = roi if channels == 1 else roi[:, :, :3]
+            if alpha.min() == 255:
+                # Opaque logo: straight copy
+                color_roi[...] = logo_color
             else:
-                pil_image.paste(pil_logo, (placement_x, placement_y))
+                # out = logo_premultiplied + background * (1 - alpha)
+                keep = (255 - alpha).astype(np.float32) / 255.0
+                if channels != 1:
+                    keep = keep[:, :, None]
+                color_roi[...] = np.rint(logo_color + color_roi * keep).astype(np.uint8)
             
-            # Convert back to numpy array
-            return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+            if channels == 4:
+                # Transparent source: the logo adds its own coverage to the alpha channel
+                dst_alpha = roi[:, :, 3].astype(np.float32)
+                roi[:, :, 3] = np.rint(alpha + dst_alpha * (1.0 - alpha / 255.0)).astype(np.uint8)
+            
+            return image
             
         except Exception as e:
             print(f"Error creating composite: {e}")
@@ -232,42 +2393,114 @@ class LogoPlacementAnalyzer:
         except:
             return None, None
     
-    def upload_to_s3(self, image_array, original_s3_url):
-        """Upload composite image to S3 in same location as original"""
+    def source_format(self, image_data):
+        """Output format matching the downloaded image (PNG for formats we don't write)"""
+        try:
+            return SOURCE_FORMATS.get(Image.open(io.BytesIO(image_data)).format, 'png')
+        except Exception:
+            return 'png'
+    
+    @timed('encode')
+    def encode_image(self, image_array, output=None, source_format='png'):
+        """Encode composite for storage, returning bytes buffer, content type and extension"""
+        output = output or {}
+        output_format = output.get('format', self.output_defaults['format'])
+        if output_format == 'source':
+            output_format = source_format
+        
+        optimize = output.get('optimize', self.output_defaults['optimize'])
+        if output_format == 'jpeg':
+            # JPEG has no alpha channel
+            if len(image_array.shape) == 3 and image_array.shape[2] == 4:
+                image_array = cv2.cvtColor(image_array, cv2.COLOR_BGRA2BGR)
+            params = [
+                cv2.IMWRITE_JPEG_QUALITY, output.get('quality', self.output_defaults['jpeg_quality']),
+                cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize),
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(optimize)
+            ]
+        elif output_format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, output.get('quality', self.output_defaults['webp_quality'])]
+        else:
+            output_format = 'png'
+            # optimize trades CPU for the smallest PNG
+            compression = 9 if optimize else output.get('png_compression', self.output_defaults['png_compression'])
+            params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        
+        success, buffer = cv2.imencode('.' + OUTPUT_FORMATS[output_format]['extension'], image_array, params)
+        if not success:
+            raise ValueError(f"Failed to encode image as {output_format}")
+        
+        return {
+            'data': buffer,
+            'format': output_format,
+            'content_type': OUTPUT_FORMATS[output_format]['content_type'],
+            'extension': OUTPUT_FORMATS[output_format]['extension']
+        }
+    
+    @timed('encode')
+    def encode_frames(self, frames, composites, output=None):
+        """Encode composited frames back into the sequence's own container (output_format is for stills)
+        
+        composites is consumed one frame at a time, so this also covers decoding and compositing them.
+        """
+        output = output or {}
+        data = frames.write(composites, output.get('quality', self.output_defaults['webp_quality']))
+        spec = format_spec(frames.format)
+        return {
+            'data': np.frombuffer(data, dtype=np.uint8),
+            'format': frames.format,
+            'content_type': spec['content_type'],
+            'extension': spec['extension']
+        }
+    
+    def save_local_output(self, encoded, retry_url=None):
+        """Spool the encoded composite (written in the background) and return its path
+        
+        With retry_url, the S3 original whose upload failed, the spool keeps retrying the upload.
+        """
+        return self.spool.write(encoded, retry_url)
+    
+    @timed('s3_upload')
+    def upload_to_s3(self, encoded, original_s3_url):
+        """Upload encoded composite image to S3 in same location as original"""
         try:
             bucket, original_key = self.parse_s3_url(original_s3_url)
             if not bucket or not original_key:
                 return None
             
-            # Create new key with -logo suffix
+            # Create new key with -logo suffix, keeping the extension if it matches the output format
             key_parts = original_key.rsplit('.', 1)
-            if len(key_parts) == 2:
+            if len(key_parts) == 2 and key_parts[1].lower() in format_spec(encoded['format'])['aliases']:
                 new_key = f"{key_parts[0]}-logo.{key_parts[1]}"
+            elif len(key_parts) == 2 and '/' not in key_parts[1]:
+                new_key = f"{key_parts[0]}-logo.{encoded['extension']}"
             else:
-                new_key = f"{original_key}-logo.png"
-            
-            # Convert image array to bytes
-            success, buffer = cv2.imencode('.png', image_array)
-            if not success:
-                return None
+                new_key = f"{original_key}-logo.{encoded['extension']}"
             
-            # Upload to S3
-            self.s3_client.put_object(
-                Bucket=bucket,
-                Key=new_key,
-                Body=buffer.tobytes(),
-                ContentType='image/png'
+            # Upload to S3 straight from the encoder's buffer (multipart when large)
+            self.s3_client.upload_fileobj(
+                BufferReader(encoded['data']),
+                bucket,
+                new_key,
+                ExtraArgs={'ContentType': encoded['content_type']},
+                Config=self.s3_transfer_config
             )
             
             # Return the S3 URL
             return f"https://{bucket}.s3.amazonaws.com/{new_key}"
             
-        except (NoCredentialsError, ClientError) as e:
+        except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+            # Includes connection errors and credential/profile problems building the client
             print(f"S3 upload error: {e}")
+            self.metrics.inc('failures', 's3_upload_error')
             return None
     
+    @timed('s3_delete')
     def delete_original_s3_image(self, s3_url):
-        """Delete the original S3 image"""
+        """Delete the original S3 image; False when it failed in a way retrying won't fix
+        
+        Throttling, 5xx and connection errors are raised for the caller to retry.
+        """
         try:
             bucket, key = self.parse_s3_url(s3_url)
             if bucket and key:
@@ -275,100 +2508,81 @@ class LogoPlacementAnalyzer:
                 print(f"Deleted original S3 image: {s3_url}")
                 return True
             return False
-        except (NoCredentialsError, ClientError) as e:
+        except Exception as e:
+            if retryable_s3_error(e):
+                raise
             print(f"S3 delete error: {e}")
             return False
-        except Exception as e:
-            print(f"Error deleting original image: {e}")
+    
+    def schedule_original_delete(self, s3_url):
+        """Delete the original in the background, retrying transient errors with backoff
+        
+        Returns the delete's Future (its result is whether the original went), or None
+        if it isn't an S3 URL.
+        """
+        bucket, key = self.parse_s3_url(s3_url)
+        if not bucket or not key:
+            return None
+        
+        def delete():
+            for attempt in range(self.delete_retries):
+                if attempt:
+                    time.sleep(min(30, 0.5 * 2 ** (attempt - 1)))
+                try:
+                    if self.delete_original_s3_image(s3_url):
+                        return True
+                    break  # Permanent failure; retrying won't help
+                except Exception as e:
+                    print(f"S3 delete error (attempt {attempt + 1}/{self.delete_retries}): {e}")
+            print(f"Giving up deleting original S3 image: {s3_url}")
+            self.metrics.inc('failures', 's3_delete_error')
             return False
+        
+        return self.delete_pool.submit(delete)
     
-    def get_logo_dimensions(self, dark_logo_url, light_logo_url):
-        """Get actual logo dimensions from one of the logo URLs"""
-        try:
-            # Try dark logo first if available
-            if dark_logo_url:
-                logo_image = self.download_image(dark_logo_url)
-                h, w = logo_image.shape[:2]
-                return w, h
-        except:
-            pass
-            
-        try:
-            # Fallback to light logo if available
-            if light_logo_url:
-                logo_image = self.download_image(light_logo_url)
-                h, w = logo_image.shape[:2]
-                return w, h
-        except:
-            pass
+    @timed('logo_fetch')
+    def fetch_logo(self, logo_url):
+        """Download (or revalidate) a logo into the logo cache"""
+        return self.logo_cache.get(logo_url)
+    
+    def get_logo_dimensions(self, dark_logo_url, light_logo_url, image_size=None):
+        """Placement (width, height) for the logo
+        
+        With image_size (width, height): the atlas render closest to LOGO_SIZE of the image's
+        short edge. Without it, or with LOGO_SIZE 0: the logo's native size.
+        """
+        for logo_url in (dark_logo_url, light_logo_url):
+            # Try dark logo first, falling back to light
+            if not logo_url:
+                continue
+            try:
+                if image_size and self.logo_size:
+                    render = self.logo_cache.get_render(logo_url, self.logo_size * min(image_size))
+                    return render.shape[1], render.shape[0]
+                return self.logo_cache.get_dimensions(logo_url)
+            except Exception:
+                pass
             
         # Ultimate fallback to default
         return 100, 50
     
-    def analyze_placement_only(self, image_url):
-        """Analyze placement without logos - just return best corner"""
+    def analyze_placement_only(self, image_url, text_detector=None):
+        """Analyze placement without logos - just return best corner
+        
+        The pipeline stops after select; full resolution is never needed here.
+        """
         try:
-            # Download and process image
-            image = self.download_image(image_url)
-            h, w = image.shape[:2]
-            
-            # Use default logo dimensions for analysis
-            logo_width, logo_height = 100, 50
-            
-            # Analyze all corners
-            corners = ['top-left', 'top-right', 'bottom-left', 'bottom-right']
-            all_corner_results = []
-            
-            for corner in corners:
-                corner_result = self.analyze_corner_space(image, corner, logo_width, logo_height)
-                if corner_result:
-                    # Add bias for corners (bottom-right most preferred)
-                    if corner == 'bottom-right':
-                        corner_result['suitability'] *= 1.25  # 25% bonus for bottom-right
-                    elif corner == 'bottom-left':
-                        corner_result['suitability'] *= 1.15  # 15% bonus for bottom-left
-                    elif corner == 'top-right':
-                        corner_result['suitability'] *= 1.05  # 5% bonus for top-right
-                    
-                    all_corner_results.append(corner_result)
-            
-            # Sort by suitability
-            all_corner_results.sort(key=lambda x: x['suitability'], reverse=True)
-            best_corner = all_corner_results[0] if all_corner_results else None
-            
-            # Base response structure
-            result = {
-                'status': 'failed',
-                'reason': None,
-                'placement': None,
-                'selected_logo': None
-            }
-            
-            if not best_corner:
-                result['reason'] = 'No corners found suitable for logo placement'
-                return result
-            
-            if not best_corner['space_sufficient']:
-                result['reason'] = f"Insufficient space in best corner ({best_corner['corner']}). Available: {best_corner['available_width']}x{best_corner['available_height']}, Required: {logo_width}x{logo_height}"
-                return result
-            
-            if best_corner['suitability'] < 0.3:  # Low confidence threshold
-                result['reason'] = f"Low placement confidence ({best_corner['suitability']:.2f}) in best corner ({best_corner['corner']}). May have text or visual conflicts."
-                return result
-            
-            # Success case
-            result['status'] = 'successful'
-            result['placement'] = {
-                'corner': best_corner['corner'],
-                'x': best_corner['placement_x'],
-                'y': best_corner['placement_y'],
-                'width': logo_width,
-                'height': logo_height
-            }
-            
-            return result
+            state = self.pipeline.run({
+                'source': image_url,
+                'text_detector': text_detector,
+                'logo_size': (100, 50)  # Default logo dimensions for analysis
+            }, stages=('decode', 'features', 'score', 'select'))
+            return state['result']
             
+        except OverloadedError:
+            raise
         except Exception as e:
+            self.metrics.inc('failures', failure_reason(e))
             return {
                 'status': 'failed',
                 'reason': f'Processing error: {str(e)}',
@@ -376,134 +2590,34 @@ class LogoPlacementAnalyzer:
                 'selected_logo': None
             }
     
-    def analyze_placement(self, image_url, dark_logo_url, light_logo_url, return_image=True, upload_to_s3=True, delete_original=True):
-        """Main analysis function"""
+    def analyze_placement(self, image_url, dark_logo_url, light_logo_url, return_image=True, upload_to_s3=True, delete_original=True, text_detector=None, output=None, inline=False):
+        """Main analysis function
+        
+        image_url may be any fetch_image source. With inline the composite comes back as
+        output_image_data bytes and nothing is stored or deleted.
+        """
         try:
-            # Download and process image
-            image = self.download_image(image_url)
-            h, w = image.shape[:2]
-            
-            # Get actual logo dimensions
-            logo_width, logo_height = self.get_logo_dimensions(dark_logo_url, light_logo_url)
-            
-            # Analyze all corners for detailed reporting
-            corners = ['top-left', 'top-right', 'bottom-left', 'bottom-right']
-            all_corner_results = []
-            
-            for corner in corners:
-                corner_result = self.analyze_corner_space(image, corner, logo_width, logo_height)
-                if corner_result:
-                    # Add bias for corners (bottom-right most preferred)
-                    if corner == 'bottom-right':
-                        corner_result['suitability'] *= 1.25  # 25% bonus for bottom-right
-                    elif corner == 'bottom-left':
-                        corner_result['suitability'] *= 1.15  # 15% bonus for bottom-left
-                    elif corner == 'top-right':
-                        corner_result['suitability'] *= 1.05  # 5% bonus for top-right
-                    
-                    all_corner_results.append(corner_result)
-            
-            # Sort by suitability
-            all_corner_results.sort(key=lambda x: x['suitability'], reverse=True)
-            best_corner = all_corner_results[0] if all_corner_results else None
-            
-            # Base response structure (simplified)
-            result = {
-                'status': 'failed',
-                'reason': None,
-                'placement': None,
-                'selected_logo': None,
-                'output_image': None
-            }
-            
-            if not best_corner:
-                result['reason'] = 'No corners found suitable for logo placement'
-                result['original_deleted'] = False
-                return result
-            
-            if not best_corner['space_sufficient']:
-                result['reason'] = f"Insufficient space in best corner ({best_corner['corner']}). Available: {best_corner['available_width']}x{best_corner['available_height']}, Required: {logo_width}x{logo_height}"
-                result['original_deleted'] = False
-                return result
-            
-            if best_corner['suitability'] < 0.3:  # Low confidence threshold
-                result['reason'] = f"Low placement confidence ({best_corner['suitability']:.2f}) in best corner ({best_corner['corner']}). May have text or visual conflicts."
-                result['original_deleted'] = False
-                return result
-            
-            # Success case
-            result['status'] = 'successful'
-            
-            # Select logo variant based on available logos
-            if dark_logo_url and light_logo_url:
-                # Both logos available - choose based on contrast
-                logo_selection = self.select_logo_variant(
-                    image,
-                    best_corner['placement_x'],
-                    best_corner['placement_y'],
-                    logo_width,
-                    logo_height
-                )
-                selected_logo_url = dark_logo_url if logo_selection['use_dark_logo'] else light_logo_url
-            elif dark_logo_url:
-                # Only dark logo available
-                selected_logo_url = dark_logo_url
-            else:
-                # Only light logo available  
-                selected_logo_url = light_logo_url
-            
-            # Update result with success data
-            result.update({
-                'placement': {
-                    'corner': best_corner['corner'],
-                    'x': best_corner['placement_x'],
-                    'y': best_corner['placement_y'],
-                    'width': logo_width,
-                    'height': logo_height
-                },
-                'selected_logo': selected_logo_url
-            })
-            
-            # Create composite image if requested
-            if return_image:
-                composite = self.create_logo_composite(
-                    image, 
-                    selected_logo_url,
-                    best_corner['placement_x'],
-                    best_corner['placement_y'],
-                    logo_width, logo_height
-                )
-                
-                # Handle S3 vs local storage based on preference
-                if upload_to_s3:
-                    s3_url = self.upload_to_s3(composite, image_url)
-                    if s3_url:
-                        result['output_image'] = s3_url
-                    else:
-                        # S3 failed, fallback to local file
-                        output_filename = f"output_{uuid.uuid4().hex[:8]}.png"
-                        output_path = os.path.join("outputs", output_filename)
-                        os.makedirs("outputs", exist_ok=True)
-                        cv2.imwrite(output_path, composite)
-                        result['output_image'] = output_path
-                else:
-                    # Force local storage
-                    output_filename = f"output_{uuid.uuid4().hex[:8]}.png"
-                    output_path = os.path.join("outputs", output_filename)
-                    os.makedirs("outputs", exist_ok=True)
-                    cv2.imwrite(output_path, composite)
-                    result['output_image'] = output_path
-            
-            # Delete original S3 image if requested
-            if delete_original and result['status'] == 'successful':
-                deleted = self.delete_original_s3_image(image_url)
-                result['original_deleted'] = deleted
-            else:
-                result['original_deleted'] = False
-            
+            # Without return_image nothing is composited, though the original may still be deleted
+            stages = PlacementPipeline.STAGES if return_image else ('decode', 'features', 'score', 'select', 'store')
+            state = self.pipeline.run({
+                'source': image_url,
+                'logo_urls': (dark_logo_url, light_logo_url),
+                'text_detector': text_detector,
+                'composite': return_image,
+                'output': output,
+                'upload_to_s3': upload_to_s3,
+                'delete_original': delete_original,
+                'inline': inline
+            }, stages=stages)
+            result = state['result']
+            result.setdefault('output_image', None)
+            result.setdefault('original_deleted', False)
             return result
             
+        except OverloadedError:
+            raise
         except Exception as e:
+            self.metrics.inc('failures', failure_reason(e))
             return {
                 'status': 'failed',
                 'reason': f'Processing error: {str(e)}',
@@ -513,60 +2627,490 @@ class LogoPlacementAnalyzer:
                 'original_deleted': False
             }
 
+    def process_image(self, image_url, dark_logo_url, light_logo_url, return_image=True, upload_to_s3=True, delete_original=True, text_detector=None, output=None, inline=False, queue_timeout=None):
+        """Full placement when logos are given, placement analysis only when they aren't
+        
+        Runs under admission control; with queue_timeout, raises OverloadedError rather
+        than waiting longer than that for a slot or memory.
+        """
+        with self.admission.admit(queue_timeout), self.metrics.span('request'):
+            if not dark_logo_url and not light_logo_url:
+                # No logos: placement analysis only, original is never deleted
+                result = self.analyze_placement_only(image_url, text_detector)
+                result['output_image'] = image_url if isinstance(image_url, str) else None
+                result['original_deleted'] = False
+            else:
+                result = self.analyze_placement(
+                    image_url, dark_logo_url, light_logo_url,
+                    return_image, upload_to_s3, delete_original, text_detector, output, inline
+                )
+        self.metrics.inc('requests', 'successful' if result['status'] == 'successful' else 'failed')
+        return result
+    
+    def analyze_batch(self, image_urls, dark_logo_url, light_logo_url, return_image=True, upload_to_s3=True, delete_original=True, text_detector=None, output=None, inline=False):
+        """Analyze many images against one logo pair, yielding (index, result) as each finishes"""
+        # Fetch and decode the logos once up front; every item then hits the logo cache
+        for logo_url in (dark_logo_url, light_logo_url):
+            if logo_url:
+                try:
+                    self.fetch_logo(logo_url)
+                except Exception as e:
+                    print(f"Error prefetching logo {logo_url}: {e}")
+        
+        def process(image_url):
+            return self.process_image(
+                image_url, dark_logo_url, light_logo_url,
+                return_image, upload_to_s3, delete_original, text_detector, output, inline
+            )
+        
+        futures = {self.batch_pool.submit(process, url): index for index, url in enumerate(image_urls)}
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # One bad item never takes down the batch
+                    result = {
+                        'status': 'failed',
+                        'reason': f'Processing error: {str(e)}',
+                        'placement': None,
+                        'selected_logo': None,
+                        'output_image': None,
+                        'original_deleted': False
+                    }
+                yield index, result
+        finally:
+            # Client went away - don't start items nobody will read
+            for future in futures:
+                future.cancel()
+
+class JobQueue:
+    """Persistent SQLite job queue worked by a bounded pool of background threads
+    
+    A running job holds a lease its process renews every lease / 3 seconds. Once a
+    lease runs out (the worker died, hung or was killed) the next claim re-queues it.
+    """
+    def __init__(self, db_path, analyzer, workers=2, retention=7 * 24 * 3600, lease=60):
+        self.db_path = db_path
+        self.analyzer = analyzer
+        self.workers = workers
+        self.retention = retention  # Seconds finished jobs (and their idempotency keys) are kept
+        self.lease = lease
+        self._running = set()  # IDs of jobs this process is working, for lease renewal
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._ready = False  # Schema created (or migrated) by the first connection, so importing the app writes no file
+    
+    def _create_schema(self, db):
+        # Serialised across threads and processes, so only one of them adds a missing column
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+            # PID of the process running the job (informational) and when its lease runs out
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            if 'worker_pid' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN worker_pid INTEGER')
+            if 'lease_expires' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN lease_expires REAL')
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+    
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.row_factory = sqlite3.Row
+        if not self._ready:
+            self._create_schema(db)
+            self._ready = True
+        return db
+    
+    def idempotency_key(self, params):
+        """Same image and logo pair always maps to the same job"""
+        parts = [params.get('image_url') or '', params.get('dark_logo_url') or '', params.get('light_logo_url') or '']
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+    
+    def submit(self, params):
+        """Queue a placement job, returning the existing job for a repeated image/logo pair"""
+        self.start()
+        key = self.idempotency_key(params)
+        now = time.time()
+        
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT * FROM jobs WHERE idempotency_key = ?', (key,)).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                db.execute(
+                    'INSERT INTO jobs (id, idempotency_key, status, request, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (job_id, key, 'queued', json.dumps(params), now, now)
+                )
+            elif row['status'] == 'failed':
+                # Retrying a failed job reuses its ID
+                job_id = row['id']
+                db.execute(
+                    'UPDATE jobs SET status = ?, request = ?, result = NULL, updated_at = ? WHERE id = ?',
+                    ('queued', json.dumps(params), now, job_id)
+                )
+            else:
+                job_id = row['id']
+            db.execute('COMMIT')
+        
+        self._wakeup.set()
+        return self.get(job_id)
+    
+    def get(self, job_id):
+        """Return job status (and result once finished), or None"""
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row['id'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+    
+    def _requeue_expired(self, db):
+        """Re-queue running jobs whose lease ran out; returns how many"""
+        return db.execute(
+            "UPDATE jobs SET status = 'queued', worker_pid = NULL, lease_expires = NULL "
+            "WHERE status = 'running' AND (lease_expires IS NULL OR lease_expires < ?)",
+            (time.time(),)
+        ).rowcount
+    
+    def _claim(self):
+        """Atomically move the oldest queued job (or one whose lease expired) to running"""
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            self._requeue_expired(db)
+            row = db.execute(
+                "SELECT id, request FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row:
+                now = time.time()
+                db.execute(
+                    "UPDATE jobs SET status = 'running', worker_pid = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+                    (os.getpid(), now + self.lease, now, row['id'])
+                )
+            db.execute('COMMIT')
+        if row:
+            with self._running_lock:
+                self._running.add(row['id'])
+        return row
+    
+    def _renew_leases(self):
+        """Extend the leases of jobs this process is still working"""
+        with self._running_lock:
+            running = list(self._running)
+        if not running:
+            return
+        with closing(self._connect()) as db:
+            db.execute(
+                f"UPDATE jobs SET lease_expires = ? WHERE status = 'running' AND worker_pid = ? AND id IN ({','.join('?' * len(running))})",
+                (time.time() + self.lease, os.getpid(), *running)
+            )
+    
+    def _finish(self, job_id, result):
+        status = 'successful' if result.get('status') == 'successful' else 'failed'
+        with closing(self._connect()) as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, result = ?, lease_expires = NULL, updated_at = ? WHERE id = ?',
+                (status, json.dumps(serialise_result(result)), time.time(), job_id)
+            )
+    
+    def _prune(self):
+        """Drop finished jobs past retention"""
+        with closing(self._connect()) as db:
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('successful', 'failed') AND updated_at < ?",
+                (time.time() - self.retention,)
+            )
+    
+    def _work(self):
+        errors = 0
+        while True:
+            try:
+                worked = self._work_one()
+                errors = 0
+            except Exception as e:
+                # e.g. "database is locked": back off and carry on; the job's lease lapses and it is reclaimed
+                errors += 1
+                print(f"Job worker error: {e}")
+                time.sleep(min(30, 0.5 * 2 ** (errors - 1)))
+                continue
+            if not worked:
+                # Idle: wait for a submit, polling so jobs queued by other processes are picked up
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+    
+    def _work_one(self):
+        """Claim and run one job; False when none is queued"""
+        row = self._claim()
+        if row is None:
+            return False
+        try:
+            params = json.loads(row['request'])
+            try:
+                result = self.analyzer.process_image(
+                    params['image_url'],
+                    params.get('dark_logo_url'),
+                    params.get('light_logo_url'),
+                    params.get('return_image', True),
+                    params.get('upload_to_s3', True),
+                    params.get('delete_original', True),
+                    params.get('text_detector'),
+                    params.get('output'),
+                    params.get('inline', False)
+                )
+            except Exception as e:
+                result = {'status': 'failed', 'reason': f'Processing error: {str(e)}'}
+            self._finish(row['id'], result)
+        finally:
+            # Stop renewing even if finishing failed, so the lease lapses and the job is reclaimed
+            with self._running_lock:
+                self._running.discard(row['id'])
+        return True
+    
+    def _maintain(self):
+        pruned = None
+        while True:
+            try:
+                self._renew_leases()
+                if pruned is None or time.monotonic() - pruned > 3600:
+                    self._prune()
+                    pruned = time.monotonic()
+            except Exception as e:
+                print(f"Job maintenance error: {e}")
+            time.sleep(self.lease / 3)
+    
+    def start(self):
+        """Start worker threads once per process; jobs interrupted by a restart are re-queued once their lease expires"""
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._maintain, name='job-maintenance', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
 analyzer = LogoPlacementAnalyzer()
+job_queue = JobQueue(
+    os.path.join(APP_DIR, os.environ.get('JOB_DB_PATH', 'jobs.db')),
+    analyzer,
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    lease=int(os.environ.get('JOB_LEASE_SECONDS', 60))
+)
+# Job threads are started per process: by gunicorn's post_fork hook, the dev server below,
+# or the first async submit. Starting them here would leave them in the preloading master.
+
+# Uploads (multipart or base64 in JSON) are capped just above the image byte ceiling
+app.config['MAX_CONTENT_LENGTH'] = analyzer.max_image_bytes * 4 // 3 + 1024 * 1024
+
+def request_params():
+    """(params, uploaded image bytes or None) from a JSON body or a multipart form with an `image` file"""
+    if request.files or request.form:
+        # Form values are strings; map true/false so flags behave as in JSON
+        data = {
+            key: {'true': True, 'false': False}.get(value.lower(), value)
+            for key, value in request.form.items()
+        }
+        upload = request.files['image'].read() if 'image' in request.files else None
+        return data, upload
+    return request.get_json(), None
 
 @app.route('/analyze-placement', methods=['POST'])
 def analyze_placement():
     """Analyze logo placement for given image and logo variants"""
     try:
-        data = request.get_json()
+        data, upload = request_params()
         
-        if not data:
+        if not data and not upload:
             return jsonify({'error': 'No JSON data provided'}), 400
+        data = data or {}
         
-        # Check required fields - image_url is always required
-        if 'image_url' not in data:
-            return jsonify({'error': 'Missing required field: image_url'}), 400
+        # The image comes as a URL/URI/path, base64 in the JSON, or a multipart upload
+        if data.get('image_base64'):
+            try:
+                upload = base64.b64decode(data['image_base64'], validate=True)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'image_base64 is not valid base64'}), 400
+        image = upload or data.get('image_url')
+        if not image:
+            return jsonify({'error': 'Missing required field: image_url (or image_base64, or an uploaded image file)'}), 400
         
         # At least one logo URL must be provided
         dark_logo_url = data.get('dark_logo_url')
         light_logo_url = data.get('light_logo_url')
         
-        # Special case: no logos provided - just return placement analysis
-        if not dark_logo_url and not light_logo_url:
-            # Just analyze placement without logos
-            result = analyzer.analyze_placement_only(data['image_url'])
-            result['output_image'] = data['image_url']  # Return same filename
-            result['original_deleted'] = False  # Never delete original
-            return jsonify(result), 200 if result['status'] == 'successful' else 400
+        # Optional per-request text detector backend
+        text_detector = data.get('text_detector')
+        if text_detector and text_detector not in analyzer.text_detectors:
+            return jsonify({'error': f"Unknown text_detector: {text_detector}. Use one of: {', '.join(analyzer.text_detectors)}"}), 400
+        
+        # Optional per-request output encoding
+        try:
+            output = parse_output_options(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Job mode: queue the work and return a job ID straight away
+        if data.get('async'):
+            if not isinstance(image, str):
+                return jsonify({'error': 'async requires image_url; uploaded images are processed synchronously'}), 400
+            job = job_queue.submit({
+                'image_url': data['image_url'],
+                'dark_logo_url': dark_logo_url,
+                'light_logo_url': light_logo_url,
+                'return_image': data.get('return_image', True),
+                'upload_to_s3': data.get('upload_to_s3', True),
+                'delete_original': data.get('delete_original', True),
+                'text_detector': text_detector,
+                'output': output,
+                'inline': bool(data.get('inline', False))
+            })
+            job['status_url'] = f"/jobs/{job['job_id']}"
+            return jsonify(job), 202
         
         # Check if user wants the output image and S3 upload preference
         return_image = data.get('return_image', True)  # Default to True as promised
         upload_to_s3 = data.get('upload_to_s3', True)
         delete_original = data.get('delete_original', True)  # Default to True
         
-        result = analyzer.analyze_placement(
-            data['image_url'],
-            dark_logo_url,
-            light_logo_url,
-            return_image,
-            upload_to_s3,
-            delete_original
-        )
+        # No logos provided: placement analysis only, same filename back, original never deleted
+        with analyzer.metrics.collect() as timings:
+            result = analyzer.process_image(
+                image,
+                dark_logo_url,
+                light_logo_url,
+                return_image,
+                upload_to_s3,
+                delete_original,
+                text_detector,
+                output,
+                bool(data.get('inline', False)),
+                queue_timeout=analyzer.admission.queue_timeout
+            )
+        
+        # Optional per-stage breakdown (milliseconds) for finding slow requests
+        if data.get('debug'):
+            result['timings'] = timings
         
         # Return appropriate HTTP status based on analysis result
         if result['status'] == 'successful':
-            return jsonify(result), 200
+            return jsonify(serialise_result(result)), 200
         else:
-            return jsonify(result), 400
+            return jsonify(serialise_result(result)), 400
+    
+    except OverloadedError as e:
+        # Saturated: tell the client (and load balancer) when to come back instead of queueing
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), e.status, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/analyze-placement/batch', methods=['POST'])
+def analyze_placement_batch():
+    """Analyze many images against one logo pair, streaming NDJSON results as they finish"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+        
+        image_urls = data.get('image_urls')
+        if not image_urls or not isinstance(image_urls, list):
+            return jsonify({'error': 'Missing required field: image_urls (list)'}), 400
+        
+        if len(image_urls) > analyzer.batch_max_images:
+            return jsonify({'error': f'Too many images: {len(image_urls)} (max {analyzer.batch_max_images})'}), 400
+        
+        text_detector = data.get('text_detector')
+        if text_detector and text_detector not in analyzer.text_detectors:
+            return jsonify({'error': f"Unknown text_detector: {text_detector}. Use one of: {', '.join(analyzer.text_detectors)}"}), 400
+        
+        # Optional per-request output encoding
+        try:
+            output = parse_output_options(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        results = analyzer.analyze_batch(
+            image_urls,
+            data.get('dark_logo_url'),
+            data.get('light_logo_url'),
+            data.get('return_image', True),
+            data.get('upload_to_s3', True),
+            data.get('delete_original', True),
+            text_detector,
+            output,
+            bool(data.get('inline', False))
+        )
+        
+        def generate():
+            for index, result in results:
+                yield json.dumps({'index': index, 'image_url': image_urls[index], **serialise_result(result)}) + '\n'
+        
+        return Response(generate(), mimetype='application/x-ndjson')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status of an async placement job, with its result once finished"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+    return jsonify(job), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'logo-placement-analyzer'})
+    return jsonify({
+        'status': 'healthy',
+        'service': 'logo-placement-analyzer',
+        'logo_cache': analyzer.logo_cache.stats(),
+        'placement_cache': analyzer.placement_cache.stats(),
+        'http': analyzer.http_stats(),
+        'admission': analyzer.admission.stats(),
+        'spool': analyzer.spool.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: stage latency histograms, request and failure counters"""
+    return Response(analyzer.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/outputs/<name>', methods=['GET'])
+def output_file(name):
+    """Serve a spooled composite; the file goes to the server's sendfile rather than through Python"""
+    path = analyzer.spool.path(name)
+    if not path:
+        return jsonify({'error': f'Output not found: {name}'}), 404
+    extension = name.rpartition('.')[2].lower()
+    specs = itertools.chain(OUTPUT_FORMATS.values(), MULTIFRAME_FORMATS.values())
+    content_type = next((spec['content_type'] for spec in specs if extension in spec['aliases']), None)
+    return send_file(path, mimetype=content_type, conditional=True, max_age=analyzer.spool.ttl)
 
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
@@ -586,11 +3130,12 @@ def cleanup_files():
         
         for file_path in files:
             try:
-                if os.path.exists(file_path) and file_path.startswith('outputs/'):
-                    os.remove(file_path)
+                if os.path.exists(file_path) and analyzer.spool.remove(file_path):
                     deleted.append(file_path)
                 else:
                     errors.append(f"File not found or invalid path: {file_path}")
+            except FileNotFoundError:
+                errors.append(f"File not found or invalid path: {file_path}")
             except Exception as e:
                 errors.append(f"Error deleting {file_path}: {str(e)}")
         
@@ -603,4 +3148,7 @@ def cleanup_files():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    # Pick up jobs queued and uploads spooled before the last restart
+    job_queue.start()
+    analyzer.spool.start()
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
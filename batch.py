@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Bulk logo placement for backfills
+
+Reads a manifest of images and processes it across a pool of worker processes,
+appending one JSON result per image to a results file. Re-running with the same
+results file skips images already done, so an interrupted run resumes.
+
+    python batch.py manifest.csv --dark-logo https://.../dark.png --light-logo https://.../light.png
+    python batch.py manifest.jsonl --results merchant.results.jsonl --workers 8
+    python batch.py manifest.csv --retry-failed
+
+Manifest rows (CSV with a header row, or JSON lines) have an `image_url` (any
+input the service accepts: http(s) URL, s3:// URI or local path) or an
+`s3_prefix` (every image under it), plus optional `dark_logo_url` /
+`light_logo_url` and output options (`output_format`, `output_quality`,
+`png_compression`, `optimize`, `text_detector`). Logo URLs given on the
+command line apply to rows that don't name their own.
+"""
+
+import argparse
+import csv
+import functools
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import sys
+import time
+
+# One OCR thread per Tesseract process and a small corner pool per worker: the
+# process pool already fills every core
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+os.environ.setdefault('CORNER_POOL_WORKERS', '2')
+
+from app import MULTIFRAME_FORMATS, OUTPUT_FORMATS, analyzer, parse_output_options, serialise_result
+
+# Stills, animations and video clips
+IMAGE_EXTENSIONS = {
+    alias for formats in (OUTPUT_FORMATS, MULTIFRAME_FORMATS) for spec in formats.values() for alias in spec['aliases']
+} | {'bmp'}
+
+def read_manifest(path):
+    """Yield manifest rows as dicts from a CSV (header row) or JSONL file"""
+    with open(path, newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson', '.json')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                # Empty CSV cells mean "not set"; true/false behave as they do in JSON
+                yield {
+                    key: {'true': True, 'false': False}.get(value.lower(), value)
+                    for key, value in row.items() if key and value not in (None, '')
+                }
+
+def expand_s3_prefix(prefix):
+    """Yield s3:// URIs of the images under an s3://bucket/prefix, skipping our own composites"""
+    bucket, key_prefix = analyzer.parse_s3_url(prefix)
+    paginator = analyzer.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix):
+        for obj in page.get('Contents', []):
+            stem, _, extension = obj['Key'].rpartition('.')
+            if extension.lower() in IMAGE_EXTENSIONS and not stem.endswith('-logo'):
+                yield f"s3://{bucket}/{obj['Key']}"
+
+def build_tasks(rows, args):
+    """Turn manifest rows into per-image tasks, expanding S3 prefixes"""
+    for row in rows:
+        task = {
+            'dark_logo_url': row.get('dark_logo_url') or args.dark_logo,
+            'light_logo_url': row.get('light_logo_url') or args.light_logo,
+            'text_detector': row.get('text_detector') or args.text_detector
+        }
+        try:
+            task['output'] = parse_output_options({'output_format': args.output_format, **row})
+        except (TypeError, ValueError) as e:
+            # A bad row fails on its own rather than stopping the run
+            task['error'] = str(e)
+        if row.get('s3_prefix'):
+            for image_url in expand_s3_prefix(row['s3_prefix']):
+                yield {'image_url': image_url, **task}
+        elif row.get('image_url'):
+            yield {'image_url': row['image_url'], **task}
+
+def task_key(task):
+    """Identity of a task in the results file"""
+    return (task['image_url'], task.get('dark_logo_url'), task.get('light_logo_url'))
+
+def load_done(results_path, retry_failed):
+    """Keys of tasks already recorded in the results file (only successful ones with retry_failed)"""
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Partial last line from an interrupted run
+            if retry_failed and record.get('status') != 'successful':
+                continue
+            done.add(task_key(record))
+    return done
+
+def init_worker():
+    """Fresh per-process clients and pools; drain background original deletes before exiting"""
+    # Ctrl-C is handled once, in the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    analyzer.after_fork()
+    multiprocessing.util.Finalize(analyzer, analyzer.shutdown, exitpriority=10)
+
+def run_task(task, options):
+    if task.get('error'):
+        return {'image_url': task['image_url'], 'dark_logo_url': task['dark_logo_url'],
+                'light_logo_url': task['light_logo_url'], 'status': 'failed', 'reason': task['error']}
+    try:
+        result = analyzer.process_image(
+            task['image_url'], task['dark_logo_url'], task['light_logo_url'],
+            options['return_image'], options['upload_to_s3'], options['delete_original'],
+            task['text_detector'], task['output']
+        )
+    except Exception as e:
+        result = {'status': 'failed', 'reason': f'Processing error: {str(e)}'}
+    return {
+        'image_url': task['image_url'],
+        'dark_logo_url': task['dark_logo_url'],
+        'light_logo_url': task['light_logo_url'],
+        **serialise_result(result)
+    }
+
+class Progress:
+    """Live throughput line on stderr"""
+    def __init__(self):
+        self.start = time.monotonic()
+        self.skipped = 0
+        self.done = 0
+        self.failed = 0
+        self.last = 0.0
+        self.tty = sys.stderr.isatty()
+
+    def update(self, record, final=False):
+        if record is not None:
+            self.done += 1
+            self.failed += record.get('status') != 'successful'
+        now = time.monotonic()
+        # Redraw in place on a terminal; one line every 10s when logging to a file
+        if not final and now - self.last < (0.5 if self.tty else 10):
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        line = (f"{self.done} done, {self.failed} failed, {self.skipped} skipped "
+                f"| {rate:.1f} images/s | {elapsed:.0f}s")
+        print(('\r' + line) if self.tty else line, end='' if self.tty and not final else '\n',
+              file=sys.stderr, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='CSV or JSONL manifest')
+    parser.add_argument('--results', help='Results JSONL, also the resume checkpoint (default: <manifest>.results.jsonl)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (default: CPU count)')
+    parser.add_argument('--dark-logo', help='Dark logo URL for rows without one')
+    parser.add_argument('--light-logo', help='Light logo URL for rows without one')
+    parser.add_argument('--text-detector', choices=sorted(analyzer.text_detectors), help='Text detection backend')
+    parser.add_argument('--output-format', help='source, jpeg, png or webp (default: OUTPUT_FORMAT)')
+    parser.add_argument('--no-upload', action='store_true', help='Save composites to outputs/ instead of S3')
+    parser.add_argument('--delete-originals', action='store_true', help='Delete each original once its composite is uploaded')
+    parser.add_argument('--analyze-only', action='store_true', help='Record placements without creating composites')
+    parser.add_argument('--retry-failed', action='store_true', help='Re-run images that failed in an earlier run')
+    args = parser.parse_args()
+
+    results_path = args.results or os.path.splitext(args.manifest)[0] + '.results.jsonl'
+    options = {
+        'return_image': not args.analyze_only,
+        'upload_to_s3': not args.no_upload,
+        'delete_original': args.delete_originals and not args.no_upload and not args.analyze_only
+    }
+
+    done = load_done(results_path, args.retry_failed)
+    skipped = 0
+
+    def pending():
+        nonlocal skipped
+        for task in build_tasks(read_manifest(args.manifest), args):
+            # Also skips repeats within the manifest (e.g. overlapping S3 prefixes)
+            if task_key(task) in done:
+                skipped += 1
+                continue
+            done.add(task_key(task))
+            yield task
+
+    # Fork so workers share the already-built detectors, as under gunicorn
+    context = multiprocessing.get_context('fork')
+    progress = Progress()
+    with open(results_path, 'a') as results, context.Pool(args.workers, initializer=init_worker) as pool:
+        try:
+            for record in pool.imap_unordered(functools.partial(run_task, options=options), pending()):
+                results.write(json.dumps(record) + '\n')
+                results.flush()
+                progress.skipped = skipped
+                progress.update(record)
+        except KeyboardInterrupt:
+            pool.terminate()
+            progress.update(None, final=True)
+            print(f"Interrupted; re-run the same command to resume from {results_path}", file=sys.stderr)
+            sys.exit(130)
+        pool.close()
+        pool.join()
+    progress.skipped = skipped
+    progress.update(None, final=True)
+    print(f"Results in {results_path}", file=sys.stderr)
+    sys.exit(1 if progress.failed else 0)
+
+if __name__ == '__main__':
+    main()
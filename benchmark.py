@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Logo Placement Analyzer
+
+Runs against a fixed, seeded set of synthetic images (or a directory of
+real images) so numbers are comparable between runs.
+
+    python benchmark.py ocr
+    python benchmark.py ocr --images samples/ --repeat 5
+    python benchmark.py decode
+    python benchmark.py encode
+    python benchmark.py composite
+    python benchmark.py pipeline --concurrency 4
+    python benchmark.py pipeline --s3          # upload/delete against a moto S3 mock
+    python benchmark.py drift                  # compare placements with benchmark_baseline.json
+    python benchmark.py drift --update         # accept current placements as the new baseline
+    python benchmark.py multiframe             # frames/s for GIF/WebP/video; exits 1 below --target-fps
+"""
+
+import argparse
+import functools
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from app import MULTIFRAME_FORMATS, LogoPlacementAnalyzer
+
+CORNERS = ['top-left', 'top-right', 'bottom-left', 'bottom-right']
+SIZES = [(800, 600), (1600, 1200), (3000, 2000), (4032, 3024)]
+
+def make_corpus(seed=42):
+    """Build a fixed set of synthetic images with background clutter and corner text"""
+    rng = np.random.default_rng(seed)
+    images = []
+    for w, h in SIZES:
+        for variant in range(2):
+            # Smooth gradient with mild sensor noise, like a product photo backdrop
+            gradient = np.linspace(90, 170, w, dtype=np.float32)[None, :, None]
+            noise = rng.normal(0, 6, (h, w, 3)).astype(np.float32)
+            image = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+            # Clutter: random rectangles and lines
+            for _ in range(30):
+                x, y = int(rng.integers(0, w)), int(rng.integers(0, h))
+                color = tuple(int(c) for c in rng.integers(0, 255, 3))
+                cv2.rectangle(image, (x, y), (x + int(rng.integers(10, w // 8)), y + int(rng.integers(10, h // 8))), color, 2)
+            # Text in one or two corners
+            scale = w / 800
+            cv2.putText(image, 'SALE 50% OFF', (int(30 * scale), int(60 * scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 0), max(1, int(2 * scale)))
+            if variant:
+                cv2.putText(image, 'buylocal.nz', (int(w * 0.7), int(h * 0.95)),
+                            cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), max(1, int(2 * scale)))
+            images.append((f"synthetic_{w}x{h}_{variant}", image))
+    return images
+
+def load_images(path):
+    """Load every image in a directory as a BGR numpy array"""
+    images = []
+    for name in sorted(os.listdir(path)):
+        image = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append((name, image))
+    return images
+
+def time_call(fn, repeat):
+    """Return best wall time of fn over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def legacy_corner_ocr(analyzer, image):
+    """Previous behaviour: one Tesseract run per corner"""
+    regions = analyzer.get_corner_regions(image)
+    results = {}
+    for corner in CORNERS:
+        x1, y1, x2, y2 = regions[corner]
+        gray = cv2.cvtColor(image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+        results[corner] = len(pytesseract.image_to_string(gray).strip()) > 0
+    return results
+
+def bench_ocr(analyzer, images, args):
+    """Compare four per-corner OCR runs against the single-pass detector backends"""
+    backends = list(analyzer.text_detectors)
+    repeat = args.repeat
+    print(f"{'image':<28}{'per-corner (s)':>16}" + ''.join(f"{name + ' (s)':>18}{'agree':>8}" for name in backends))
+    totals = {'per-corner': 0.0, **{name: 0.0 for name in backends}}
+    for name, image in images:
+        old = time_call(lambda: legacy_corner_ocr(analyzer, image), repeat)
+        totals['per-corner'] += old
+        old_flags = legacy_corner_ocr(analyzer, image)
+        row = f"{name:<28}{old:>16.3f}"
+        for backend in backends:
+            new = time_call(lambda: analyzer.detect_text(image, backend), repeat)
+            totals[backend] += new
+            new_flags = {c: d['has_text'] for c, d in analyzer.detect_text(image, backend).items()}
+            agree = sum(old_flags[c] == new_flags[c] for c in CORNERS)
+            row += f"{new:>18.3f}{agree:>6}/4"
+        print(row)
+    print(f"{'total':<28}{totals['per-corner']:>16.3f}" + ''.join(
+        f"{totals[b]:>18.3f}{totals['per-corner'] / totals[b]:>7.1f}x" for b in backends))
+
+def _isolated_worker(fn, conn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    conn.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, result))
+    conn.close()
+
+def run_isolated(fn):
+    """Run fn in a forked child; return (wall time, peak RSS in MB, fn's result) for that child
+
+    The child starts with the parent's resident pages, so compare RSS between paths
+    rather than reading it as an absolute cost.
+    """
+    parent, child = multiprocessing.get_context('fork').Pipe()
+    process = multiprocessing.get_context('fork').Process(target=_isolated_worker, args=(fn, child))
+    process.start()
+    elapsed, max_rss_kb, result = parent.recv()
+    process.join()
+    return elapsed, max_rss_kb / 1024, result
+
+def bench_decode(analyzer, images, args):
+    """Compare full-resolution decode + scoring against the downscaled analysis path"""
+    corners = CORNERS
+    repeat = args.repeat
+    print(f"{'image':<28}{'full (s)':>10}{'full RSS MB':>13}{'working (s)':>13}{'working RSS MB':>16}")
+    for name, image in images:
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        data = encoded.tobytes()
+
+        def full():
+            decoded, scale = analyzer.decode_image(data)
+            analyzer.analyze_corners(decoded, corners, 150, 75, scale=scale)
+
+        def working():
+            decoded, scale = analyzer.decode_image(data, analyzer.analysis_max_size)
+            analyzer.analyze_corners(decoded, corners, 150, 75, scale=scale)
+
+        full_runs = [run_isolated(full) for _ in range(repeat)]
+        working_runs = [run_isolated(working) for _ in range(repeat)]
+        print(f"{name:<28}{min(r[0] for r in full_runs):>10.3f}{max(r[1] for r in full_runs):>13.0f}"
+              f"{min(r[0] for r in working_runs):>13.3f}{max(r[1] for r in working_runs):>16.0f}")
+
+def make_logo(width=300, height=120):
+    """Semi-transparent synthetic logo"""
+    logo = np.zeros((height, width, 4), dtype=np.uint8)
+    cv2.rectangle(logo, (0, 0), (width - 1, height - 1), (20, 20, 20, 220), -1)
+    cv2.putText(logo, 'LOGO', (10, height - 25), cv2.FONT_HERSHEY_SIMPLEX, 2.5, (255, 255, 255, 255), 6)
+    return Image.fromarray(logo, 'RGBA')
+
+def legacy_composite(image, pil_logo, x, y):
+    """Previous behaviour: full-frame colour conversions and PIL paste"""
+    pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    pil_image.paste(pil_logo, (x, y), pil_logo)
+    return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+
+def bench_composite(analyzer, images, args):
+    """Compare full-frame PIL compositing against in-place region blending"""
+    pil_logo = make_logo()
+    logo_url = 'benchmark://logo'
+    # Seed the logo cache so only compositing is timed
+    analyzer.logo_cache._store(logo_url, {
+        'image': pil_logo, 'width': pil_logo.size[0], 'height': pil_logo.size[1],
+        'etag': None, 'last_modified': None, 'fetched_at': float('inf'), 'variants': {}
+    })
+    lw, lh = pil_logo.size
+    repeat = args.repeat
+
+    print(f"{'image':<28}{'full-frame (s)':>16}{'RSS MB':>9}{'in-place (s)':>15}{'RSS MB':>9}")
+    for name, image in images:
+        x, y = image.shape[1] - lw - 25, image.shape[0] - lh - 25
+        old = time_call(lambda: legacy_composite(image, pil_logo, x, y), repeat)
+        # Blending repeatedly into one scratch copy costs the same each run
+        scratch = image.copy()
+        new = time_call(lambda: analyzer.create_logo_composite(scratch, logo_url, x, y, lw, lh), repeat)
+        _, old_rss, _ = run_isolated(lambda: legacy_composite(image, pil_logo, x, y) is not None)
+        _, new_rss, _ = run_isolated(lambda: analyzer.create_logo_composite(image, logo_url, x, y, lw, lh) is not None)
+        print(f"{name:<28}{old:>16.4f}{old_rss:>9.0f}{new:>15.4f}{new_rss:>9.0f}")
+
+ENCODE_SETTINGS = [
+    ('png level 1', {'format': 'png', 'png_compression': 1}),
+    ('png level 6', {'format': 'png', 'png_compression': 6}),
+    ('png optimize', {'format': 'png', 'optimize': True}),
+    ('jpeg q90', {'format': 'jpeg', 'quality': 90}),
+    ('jpeg q90 optimize', {'format': 'jpeg', 'quality': 90, 'optimize': True}),
+    ('jpeg q80', {'format': 'jpeg', 'quality': 80}),
+    ('webp q90', {'format': 'webp', 'quality': 90}),
+    ('webp q80', {'format': 'webp', 'quality': 80}),
+]
+
+def bench_encode(analyzer, images, args):
+    """Encode time and output size for each output format setting"""
+    repeat = args.repeat
+    print(f"{'image':<28}{'setting':<20}{'encode (s)':>12}{'size (KB)':>12}")
+    totals = {label: [0.0, 0] for label, _ in ENCODE_SETTINGS}
+    for name, image in images:
+        for label, output in ENCODE_SETTINGS:
+            elapsed = time_call(lambda: analyzer.encode_image(image, output), repeat)
+            size = len(analyzer.encode_image(image, output)['data'])
+            totals[label][0] += elapsed
+            totals[label][1] += size
+            print(f"{name:<28}{label:<20}{elapsed:>12.3f}{size / 1024:>12.0f}")
+    print()
+    for label, (elapsed, size) in totals.items():
+        print(f"{'total':<28}{label:<20}{elapsed:>12.3f}{size / 1024:>12.0f}")
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class LocalAssets:
+    """Corpus and logos written to a temp dir and served over local HTTP
+
+    With s3=True a moto S3 mock stands in for the bucket: originals are read from
+    it as s3:// URIs and composites uploaded back beside them, so download, upload
+    and delete are exercised without AWS.
+    """
+    def __init__(self, images, s3=False):
+        self.dir = tempfile.mkdtemp(prefix='logo-bench-')
+        self.names = []
+        for name, image in images:
+            filename = f"{name}.jpg"
+            cv2.imwrite(os.path.join(self.dir, filename), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            self.names.append((name, filename))
+        make_logo().save(os.path.join(self.dir, 'logo-dark.png'))
+        light = np.array(make_logo())
+        light[:, :, :3] = 255 - light[:, :, :3]
+        Image.fromarray(light, 'RGBA').save(os.path.join(self.dir, 'logo-light.png'))
+
+        handler = functools.partial(_QuietHandler, directory=self.dir)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.dark_logo_url = f"{self.base_url}/logo-dark.png"
+        self.light_logo_url = f"{self.base_url}/logo-light.png"
+
+        self.s3 = None
+        if s3:
+            import logging
+            from moto import mock_aws
+            logging.getLogger('responses').setLevel(logging.WARNING)
+            for key, value in {'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+                               'AWS_DEFAULT_REGION': 'us-east-1'}.items():
+                os.environ.setdefault(key, value)
+            self.s3 = mock_aws()
+            self.s3.start()
+
+    def attach(self, analyzer):
+        """Spool local composites in the temp dir and point the analyzer's S3 client at the mock"""
+        analyzer.spool.directory = os.path.join(self.dir, 'outputs')
+        if not self.s3:
+            return
+        import boto3
+        analyzer._s3_client = boto3.client('s3')
+        analyzer._s3_client.create_bucket(Bucket='bench')
+
+    def url(self, filename, analyzer=None):
+        """URL for a corpus image; with S3 the original is (re)uploaded so it can be deleted again"""
+        if self.s3 and analyzer:
+            with open(os.path.join(self.dir, filename), 'rb') as f:
+                analyzer.s3_client.put_object(Bucket='bench', Key=filename, Body=f.read())
+            return f"s3://bench/{filename}"
+        return f"{self.base_url}/{filename}"
+
+    def close(self):
+        self.server.shutdown()
+        if self.s3:
+            self.s3.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def percentiles(values):
+    return np.percentile(values, [50, 95, 99]) if values else (0.0, 0.0, 0.0)
+
+def run_pipeline(analyzer, assets, args):
+    """Process every corpus image repeat times; return per-stage timings (ms) and wall time"""
+    s3 = assets.s3 is not None
+    jobs = [(name, filename) for _ in range(args.repeat) for name, filename in assets.names]
+    stages = {}
+    totals = []
+    lock = threading.Lock()
+
+    def process(job):
+        name, filename = job
+        url = assets.url(filename, analyzer)
+        start = time.perf_counter()
+        with analyzer.metrics.collect() as timings:
+            analyzer.process_image(
+                url, assets.dark_logo_url, assets.light_logo_url,
+                return_image=True, upload_to_s3=s3, delete_original=s3
+            )
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            totals.append(elapsed)
+            for stage, ms in timings.items():
+                stages.setdefault(stage, []).append(ms)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(process, jobs))
+    return {'stages': stages, 'totals': totals, 'wall': time.perf_counter() - start, 'count': len(jobs)}
+
+def bench_pipeline(analyzer, images, args):
+    """End-to-end latency percentiles, throughput and peak memory per stage against local stand-ins"""
+    # Every run does the full analysis rather than hitting cached scores
+    analyzer.placement_cache.max_entries = 0
+    assets = LocalAssets(images, s3=args.s3)
+    assets.attach(analyzer)
+    try:
+        # Peak RSS of a clean child running the whole workload
+        _, rss, stats = run_isolated(lambda: run_pipeline(analyzer, assets, args))
+    finally:
+        assets.close()
+
+    print(f"{stats['count']} images in {stats['wall']:.2f}s, concurrency {args.concurrency}: "
+          f"{stats['count'] / stats['wall']:.1f} images/s, peak RSS {rss:.0f} MB")
+    print()
+    print(f"{'stage':<18}{'requests':>10}{'p50 (ms)':>11}{'p95 (ms)':>11}{'p99 (ms)':>11}")
+    rows = [('total', stats['totals'])] + sorted(stats['stages'].items(), key=lambda item: -sum(item[1]))
+    for stage, values in rows:
+        p50, p95, p99 = percentiles(values)
+        print(f"{stage:<18}{len(values):>10}{p50:>11.1f}{p95:>11.1f}{p99:>11.1f}")
+
+    # Peak memory added by each stage on its own, for the largest image
+    name, image = max(images, key=lambda item: item[1].size)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    data = encoded.tobytes()
+    working, scale = analyzer.decode_image(data, analyzer.analysis_max_size)
+    logo_url = 'benchmark://logo'
+    analyzer.logo_cache._store(logo_url, {
+        'image': make_logo(), 'width': 300, 'height': 120,
+        'etag': None, 'last_modified': None, 'fetched_at': float('inf'), 'variants': {}
+    })
+    stage_fns = [
+        ('decode', lambda: analyzer.decode_image(data, analyzer.analysis_max_size)),
+        ('decode_full', lambda: analyzer.decode_image(data)),
+        ('corner_analysis', lambda: analyzer.analyze_corners(working, CORNERS, 300, 120, scale=scale)),
+        ('composite', lambda: analyzer.create_logo_composite(image, logo_url, 25, 25, 300, 120)),
+        ('encode', lambda: analyzer.encode_image(image, {'format': 'jpeg'})),
+    ]
+    _, baseline, _ = run_isolated(lambda: None)
+    print()
+    print(f"peak memory per stage, {name}")
+    print(f"{'stage':<18}{'RSS MB':>9}{'added MB':>10}")
+    for stage, fn in stage_fns:
+        _, stage_rss, _ = run_isolated(lambda: fn() is not None)
+        print(f"{stage:<18}{stage_rss:>9.0f}{stage_rss - baseline:>10.0f}")
+
+def placement_decisions(analyzer, images):
+    """Placement outcome per image, without compositing or storage"""
+    assets = LocalAssets(images)
+    decisions = {}
+    try:
+        for name, filename in assets.names:
+            result = analyzer.process_image(
+                assets.url(filename), assets.dark_logo_url, assets.light_logo_url,
+                return_image=False, upload_to_s3=False, delete_original=False
+            )
+            placement = result['placement'] or {}
+            decisions[name] = {
+                'status': result['status'],
+                'corner': placement.get('corner'),
+                'x': placement.get('x'),
+                'y': placement.get('y'),
+                'logo': os.path.basename(result['selected_logo']) if result['selected_logo'] else None
+            }
+    finally:
+        assets.close()
+    return decisions
+
+def bench_drift(analyzer, images, args):
+    """Compare placement decisions with a stored baseline; exits non-zero on drift"""
+    analyzer.placement_cache.max_entries = 0
+    decisions = placement_decisions(analyzer, images)
+    if args.update or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(decisions, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Wrote {len(decisions)} placements to {args.baseline}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    drifted = 0
+    for name in sorted(set(baseline) | set(decisions)):
+        old, new = baseline.get(name), decisions.get(name)
+        same = old is not None and new is not None and all(
+            old[key] == new[key] for key in ('status', 'corner', 'logo')
+        ) and all(
+            old[key] == new[key] or (old[key] is not None and new[key] is not None
+                                     and abs(old[key] - new[key]) <= args.tolerance)
+            for key in ('x', 'y')
+        )
+        if not same:
+            drifted += 1
+            print(f"DRIFT {name}: {old} -> {new}")
+    print(f"{len(decisions) - drifted}/{len(decisions)} placements match {args.baseline}")
+    if drifted:
+        sys.exit(1)
+
+# Container, frame size and frame count of each synthetic clip. WebM is smaller: OpenCV's VP8
+# encoder runs at a handful of frames/s at 720p and takes no speed settings.
+MULTIFRAME_CLIPS = [
+    ('gif', (480, 270), 48),
+    ('webp', (640, 360), 48),
+    ('mp4', (1280, 720), 150),
+    ('webm', (640, 360), 150),
+]
+
+def make_clip(image, container, size, count):
+    """Encode a clip panning across image, in the given container"""
+    height, width = image.shape[:2]
+    # A window two thirds of the image's height, sliding left to right
+    crop_h = min(height * 2 // 3, width * size[1] // size[0] * 2 // 3)
+    crop_w = crop_h * size[0] // size[1]
+    step = (width - crop_w) / max(1, count - 1)
+    frames = (
+        cv2.resize(image[:crop_h, round(i * step):round(i * step) + crop_w], size, interpolation=cv2.INTER_AREA)
+        for i in range(count)
+    )
+    if container in ('gif', 'webp'):
+        pil_frames = [Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in frames]
+        buffer = io.BytesIO()
+        pil_frames[0].save(buffer, container.upper(), save_all=True, append_images=pil_frames[1:], duration=40, loop=0)
+        return buffer.getvalue()
+    with tempfile.NamedTemporaryFile(suffix=f'.{container}') as f:
+        writer = cv2.VideoWriter(f.name, cv2.VideoWriter_fourcc(*MULTIFRAME_FORMATS[container]['fourcc']), 25, size)
+        for frame in frames:
+            writer.write(frame)
+        writer.release()
+        return f.read()
+
+def bench_multiframe(analyzer, images, args):
+    """Frames per second through the whole multi-frame path; exits non-zero below --target-fps"""
+    analyzer.placement_cache.max_entries = 0
+    assets = LocalAssets([])
+    assets.attach(analyzer)
+    name, image = max(images, key=lambda item: item[1].size)
+    print(f"clips panning across {name}, {analyzer.multiframe_samples} sampled frames each")
+    print(f"{'clip':<22}{'frames':>8}{'best (s)':>10}{'frames/s':>10}{'RSS MB':>9}{'KB out':>9}")
+    slow = 0
+    try:
+        for container, size, count in MULTIFRAME_CLIPS:
+            data = make_clip(image, container, size, count)
+
+            def process():
+                return analyzer.process_image(data, assets.dark_logo_url, assets.light_logo_url, inline=True)
+
+            result = process()
+            if result['status'] != 'successful':
+                print(f"{container:<22}failed: {result['reason']}")
+                slow += 1
+                continue
+            def isolated():
+                # Pools already running here don't survive the fork; rebuild them as a worker would
+                analyzer.after_fork()
+                return process()['status']
+
+            best = time_call(process, args.repeat)
+            _, rss, _ = run_isolated(isolated)
+            fps = result['frames'] / best
+            slow += fps < args.target_fps
+            label = f"{container} {size[0]}x{size[1]}"
+            print(f"{label:<22}{result['frames']:>8}{best:>10.2f}{fps:>10.1f}{rss:>9.0f}"
+                  f"{len(result['output_image_data']) / 1024:>9.0f}")
+    finally:
+        assets.close()
+    print(f"target {args.target_fps:g} frames/s: {len(MULTIFRAME_CLIPS) - slow}/{len(MULTIFRAME_CLIPS)} clips meet it")
+    if slow:
+        sys.exit(1)
+
+BENCHMARKS = {
+    'ocr': bench_ocr,
+    'decode': bench_decode,
+    'encode': bench_encode,
+    'composite': bench_composite,
+    'pipeline': bench_pipeline,
+    'drift': bench_drift,
+    'multiframe': bench_multiframe,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--images', help='Directory of images to use instead of the synthetic set')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per image; best time is reported')
+    parser.add_argument('--concurrency', type=int, default=1, help='pipeline: images processed at once')
+    parser.add_argument('--s3', action='store_true', help='pipeline: upload and delete against a moto S3 mock')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='drift: placements to compare against')
+    parser.add_argument('--update', action='store_true', help='drift: overwrite the baseline with current placements')
+    parser.add_argument('--tolerance', type=int, default=0, help='drift: pixels x/y may move before it counts')
+    parser.add_argument('--target-fps', type=float, default=25.0, help='multiframe: slowest acceptable frames/s per clip')
+    args = parser.parse_args()
+
+    images = load_images(args.images) if args.images else make_corpus()
+    analyzer = LogoPlacementAnalyzer()
+    BENCHMARKS[args.benchmark](analyzer, images, args)
+
+if __name__ == "__main__":
+    main()
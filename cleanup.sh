@@ -9,7 +9,10 @@ fi
 
 if [ "$1" == "all" ]; then
     echo "Deleting all output images..."
-    rm -f outputs/output_*.png
+    # Same spool directory as the app: relative paths are under the app directory
+    outputs="${OUTPUT_SPOOL_DIR:-outputs}"
+    case "$outputs" in /*) ;; *) outputs="$(dirname "$0")/$outputs" ;; esac
+    rm -f "$outputs"/output_* "$outputs"/.retry/output_*
     echo "All output images deleted."
 else
     for file in "$@"; do
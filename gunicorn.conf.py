@@ -0,0 +1,92 @@
+"""
+Gunicorn configuration for the Logo Placement Analyzer
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload), so text detectors and the
+warmed logo cache are shared copy-on-write by every worker. Anything holding
+sockets or threads (boto3/HTTP clients, thread pools, job queue threads) is
+built per worker after fork.
+"""
+
+import os
+
+# Tesseract uses OpenMP; without a limit every OCR process grabs all cores and
+# workers thrash each other. Set before the app (and any tesseract child) starts.
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+omp_thread_limit = int(os.environ['OMP_THREAD_LIMIT'])
+cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5001')
+# One worker per OMP_THREAD_LIMIT cores by default so OCR threads don't oversubscribe
+workers = int(os.environ.get('GUNICORN_WORKERS', max(1, cpu_count // omp_thread_limit)))
+worker_class = 'gthread'
+# Requests spend most of their time in downloads, S3 and GIL-releasing OpenCV calls. Admission
+# control parks queued requests on threads too, so default to its in-flight + queue bound,
+# plus a few spare so /health and /metrics still answer while saturated.
+admission_threads = int(os.environ.get('ADMISSION_MAX_INFLIGHT', 4)) + int(os.environ.get('ADMISSION_MAX_QUEUE', 8))
+threads = int(os.environ.get('GUNICORN_THREADS', admission_threads + 4))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+# On SIGTERM/SIGHUP workers stop accepting and get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = 5
+# Recycle workers now and then to hand back fragmented image buffers
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+pin_workers = os.environ.get('GUNICORN_PIN_WORKERS', 'false').lower() == 'true'
+# Spooled outputs (GET /outputs/<name>) go out with sendfile, never copied through Python
+sendfile = True
+accesslog = '-'
+
+def when_ready(server):
+    """Master, after preload and before the first fork: warm the shared logo cache"""
+    urls = [url.strip() for url in os.environ.get('LOGO_PRELOAD_URLS', '').split(',') if url.strip()]
+    if urls:
+        from app import analyzer
+        loaded = analyzer.preload_logos(urls)
+        server.log.info("Preloaded %d/%d logos", loaded, len(urls))
+
+def pin_worker(server, worker):
+    """Give each worker its own slice of cores, at least OMP_THREAD_LIMIT wide
+
+    Tesseract processes inherit the worker's affinity, so their OpenMP threads
+    stay on the worker's cores. The slice follows the worker's metrics slot
+    (see pre_fork), so a replacement takes over the cores of the worker it replaces.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = min(len(cpus), max(omp_thread_limit, len(cpus) // server.num_workers))
+    slot = (worker.metrics_slot - 1) % server.num_workers
+    start = slot * per_worker
+    cores = {cpus[(start + i) % len(cpus)] for i in range(per_worker)}
+    os.sched_setaffinity(0, cores)
+    server.log.info("Worker %s pinned to CPUs %s", worker.pid, sorted(cores))
+
+def pre_fork(server, worker):
+    """Master, before each fork: give the worker a metrics slot no live worker is writing
+
+    A replacement takes over a dead worker's slot and keeps adding to its counts.
+    """
+    from app import analyzer
+    taken = {getattr(other, 'metrics_slot', None) for other in server.WORKERS.values()}
+    free = [slot for slot in range(1, analyzer.metrics.slots) if slot not in taken]
+    if free:
+        worker.metrics_slot = free[0]
+    else:
+        # Sharing a slot can lose the odd concurrent update, but never blocks
+        worker.metrics_slot = 1 + worker.age % (analyzer.metrics.slots - 1)
+        server.log.warning("METRICS_WORKER_SLOTS exhausted; worker shares metrics slot %d", worker.metrics_slot)
+
+def post_fork(server, worker):
+    """Worker, just after fork: rebuild per-process clients, pools, job threads and spool upkeep"""
+    from app import analyzer, job_queue
+    if pin_workers and hasattr(os, 'sched_setaffinity'):
+        pin_worker(server, worker)
+    analyzer.after_fork(metrics_slot=worker.metrics_slot)
+    job_queue.start()
+    analyzer.spool.start()
+
+def worker_exit(server, worker):
+    """Let background original deletes and spool writes finish before the worker goes away"""
+    from app import analyzer
+    analyzer.shutdown(wait=True)
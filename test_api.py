@@ -46,6 +46,31 @@ def test_api():
             
     except Exception as e:
         print(f"❌ Test failed: {e}")
+    
+    print("\nTesting batch placement analysis...")
+    try:
+        batch_data = {
+            "image_urls": [test_data["image_url"], test_data["image_url"]],
+            "dark_logo_url": test_data["dark_logo_url"],
+            "light_logo_url": test_data["light_logo_url"],
+            "upload_to_s3": False,
+            "delete_original": False
+        }
+        response = requests.post(f"{base_url}/analyze-placement/batch", json=batch_data, stream=True)
+        print(f"Status: {response.status_code}")
+        
+        # One JSON result per line, in completion order
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+        for item in lines:
+            print(f"  [{item['index']}] {item['status']}: {item.get('reason') or item.get('output_image')}")
+        
+        if response.status_code == 200 and len(lines) == len(batch_data["image_urls"]):
+            print("✅ Batch test successful!")
+        else:
+            print("❌ Batch test failed")
+            
+    except Exception as e:
+        print(f"❌ Batch test failed: {e}")
 
 if __name__ == "__main__":
     test_api()
\ No newline at end of file
@@ -0,0 +1,517 @@
+"""
+In-process tests for the Logo Placement Analyzer (no running server needed)
+"""
+
+import importlib.util
+import io
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+
+import app
+
+def image_bytes(width, height, format='JPEG', colour=(120, 130, 140)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), colour).save(buffer, format)
+    return buffer.getvalue()
+
+def animation_bytes(format, frames=3, loop=0, size=(320, 240)):
+    images = [Image.new('RGB', size, (40 * i, 80, 120)) for i in range(frames)]
+    buffer = io.BytesIO()
+    images[0].save(buffer, format, save_all=True, append_images=images[1:], duration=80, loop=loop)
+    return buffer.getvalue()
+
+def logo_bytes(width, height, colour=(255, 0, 0, 128)):
+    buffer = io.BytesIO()
+    Image.new('RGBA', (width, height), colour).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def served():
+    """serve(path, body) -> URL of body on a local HTTP server for the test's duration"""
+    files = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def serve(path, body):
+        files[path] = body
+        return f"http://127.0.0.1:{server.server_port}{path}"
+
+    yield serve
+    server.shutdown()
+    server.server_close()
+
+def test_decode_image_downscales_to_the_working_size():
+    image, scale = app.analyzer.decode_image(image_bytes(3200, 2400), 1600)
+    assert image.shape[:2] == (1200, 1600)
+    assert scale == 2.0
+
+def test_placement_only_maps_working_coordinates_to_full_resolution(served, monkeypatch):
+    url = served('/photo.jpg', image_bytes(3200, 2400))
+    working = app.analyzer.analyze_placement_only(url)
+    monkeypatch.setattr(app.analyzer, 'analysis_max_size', 0)
+    full = app.analyzer.analyze_placement_only(url)
+
+    assert working['status'] == full['status'] == 'successful'
+    assert working['placement']['corner'] == full['placement']['corner']
+    # Within the rounding of one working pixel (2 full-resolution pixels) per edge
+    assert abs(working['placement']['x'] - full['placement']['x']) <= 2
+    assert abs(working['placement']['y'] - full['placement']['y']) <= 2
+
+def test_buffer_reader_streams_the_encoder_buffer():
+    data = np.frombuffer(b'0123456789', dtype=np.uint8)
+    reader = app.BufferReader(data)
+    assert reader.read(4) == b'0123'
+    reader.seek(-3, io.SEEK_END)
+    assert reader.read() == b'789'
+    assert reader.tell() == 10
+
+class FakeS3:
+    """delete_object raises the queued errors in turn, then succeeds"""
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.deletes = []
+
+    def delete_object(self, Bucket, Key):
+        self.deletes.append((Bucket, Key))
+        if self.errors:
+            raise self.errors.pop(0)
+
+def client_error(code, status):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'DeleteObject')
+
+def test_original_delete_retries_transient_errors_in_the_background(monkeypatch):
+    s3 = FakeS3(client_error('SlowDown', 503))
+    monkeypatch.setattr(app.analyzer, '_s3_client', s3)
+    delete = app.analyzer.schedule_original_delete('https://bucket.s3.amazonaws.com/photos/original.jpg')
+    assert delete.result(timeout=5) is True
+    assert s3.deletes == [('bucket', 'photos/original.jpg')] * 2
+    assert app.analyzer.schedule_original_delete('https://example.com/original.jpg') is None
+
+def test_original_delete_gives_up_at_once_on_permanent_errors(monkeypatch):
+    s3 = FakeS3(client_error('AccessDenied', 403))
+    monkeypatch.setattr(app.analyzer, '_s3_client', s3)
+    delete = app.analyzer.schedule_original_delete('https://bucket.s3.amazonaws.com/photos/original.jpg')
+    assert delete.result(timeout=5) is False
+    assert len(s3.deletes) == 1
+
+@pytest.mark.parametrize('errors, deleted', [((), True), ((client_error('AccessDenied', 403),), False)])
+def test_response_reports_whether_the_original_was_deleted(monkeypatch, errors, deleted):
+    monkeypatch.setattr(app.analyzer, '_s3_client', FakeS3(*errors))
+    state = {'result': {}, 'source': 'https://bucket.s3.amazonaws.com/photos/original.jpg', 'delete_original': True}
+    app.analyzer.pipeline.store(state)
+    assert state['result']['original_deleted'] is deleted
+
+def test_after_fork_rebuilds_pools_and_clients():
+    pool, http = app.analyzer.corner_pool, app.analyzer.http
+    app.analyzer.after_fork()
+    assert app.analyzer.corner_pool is not pool
+    assert app.analyzer.http is not http
+    # The logo cache follows the analyzer's current session rather than keeping the old one
+    assert app.analyzer.logo_cache.session is app.analyzer.http
+
+def test_logo_atlas_snaps_to_the_closest_size_and_renders_it_once(served):
+    cache = app.LogoCache()
+    url = served('/logo.png', logo_bytes(400, 200))
+    render = cache.get_render(url, 100)
+    assert render.shape == (48, 96, 4)
+    assert cache.get_render(url, 90) is render
+    assert cache.stats()['renders'] == 1
+    # Colour is premultiplied by alpha
+    assert tuple(render[24, 48]) == (0, 0, 128, 128)
+    # Native size tops the atlas; logos are never upscaled
+    assert cache.get_render(url, 1000).shape[:2] == (200, 400)
+
+def test_full_queue_answers_429_with_retry_after(monkeypatch):
+    admission = app.AdmissionController(max_inflight=1, max_queue=0, queue_timeout=5)
+    monkeypatch.setattr(app.analyzer, 'admission', admission)
+    with admission.admit():
+        response = app.app.test_client().post('/analyze-placement', json={
+            'image_url': 'http://127.0.0.1:1/image.jpg',
+            'dark_logo_url': 'http://127.0.0.1:1/dark.png',
+            'light_logo_url': 'http://127.0.0.1:1/light.png'
+        })
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert response.get_json()['retry_after'] == int(response.headers['Retry-After'])
+    assert admission.stats()['rejected']['queue_full'] == 1
+
+def test_memory_reservation_past_the_deadline_is_overloaded():
+    admission = app.AdmissionController(max_inflight=2, max_memory=100, queue_timeout=0.1)
+    with admission.admit(0.1):
+        admission.reserve(80)
+        with pytest.raises(app.OverloadedError) as raised:
+            with admission.admit(0.1):
+                admission.reserve(50)
+    assert raised.value.status == 503
+    assert raised.value.retry_after >= 1
+    assert admission.stats()['memory_reserved_mb'] == 0
+
+def encoded(data=b'x' * 100):
+    return {'data': data, 'format': 'PNG', 'extension': 'png', 'content_type': 'image/png'}
+
+def spool_counter(metrics, event):
+    line = f'logo_placement_spool_total{{event="{event}"}} '
+    return next(int(row[len(line):]) for row in metrics.render().splitlines() if row.startswith(line))
+
+def make_spool(tmp_path, **kwargs):
+    metrics = app.Metrics()
+    return app.OutputSpool(str(tmp_path / 'outputs'), metrics=metrics, **kwargs), metrics
+
+def write_now(spool, retry_url=None, age=0):
+    """Spool an output, wait for it to land and backdate it by age seconds"""
+    path = spool.write(encoded(), retry_url)
+    spool.shutdown()
+    spool.after_fork()
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_spool_evicts_oldest_over_budget_keeping_uploads_last(tmp_path):
+    spool, metrics = make_spool(tmp_path, max_bytes=250)
+    awaiting = write_now(spool, retry_url='s3://bucket/original.png', age=300)
+    oldest = write_now(spool, age=200)
+    newest = write_now(spool, age=100)
+    spool.sweep()
+    assert not os.path.exists(oldest)
+    assert os.path.exists(awaiting) and os.path.exists(newest)
+    assert spool.stats()['awaiting_upload'] == 1
+    assert spool_counter(metrics, 'evicted') == 1
+
+def test_spool_expires_outputs_past_ttl(tmp_path):
+    spool, metrics = make_spool(tmp_path, ttl=60)
+    expired = write_now(spool, retry_url='s3://bucket/original.png', age=120)
+    fresh = write_now(spool)
+    spool.sweep()
+    assert not os.path.exists(expired)
+    assert os.listdir(spool.retry_dir) == []
+    assert spool.path(os.path.basename(fresh)) == fresh
+    assert spool_counter(metrics, 'expired') == 1
+
+def test_spool_retries_failed_upload_until_it_succeeds(tmp_path):
+    spool, metrics = make_spool(tmp_path)
+    path = write_now(spool, retry_url='s3://bucket/original.png')
+    record = f"{os.path.basename(path)}.json"
+    uploads = []
+
+    spool.uploader = lambda encoded, s3_url: uploads.append((bytes(encoded['data']), s3_url))
+    spool.retry_uploads()
+    assert os.listdir(spool.retry_dir) == [record]
+
+    spool.uploader = lambda encoded, s3_url: uploads.append((bytes(encoded['data']), s3_url)) or 'https://bucket/output.png'
+    spool.retry_uploads()
+    assert os.listdir(spool.retry_dir) == []
+    assert uploads == [(b'x' * 100, 's3://bucket/original.png')] * 2
+    assert spool_counter(metrics, 'uploaded') == 1
+
+def test_animation_is_composited_frame_by_frame_keeping_its_timing(served):
+    dark = served('/dark.png', logo_bytes(64, 32, (0, 0, 0, 255)))
+    light = served('/light.png', logo_bytes(64, 32, (255, 255, 255, 255)))
+    result = app.analyzer.analyze_placement(
+        animation_bytes('GIF'), dark, light, upload_to_s3=False, delete_original=False, inline=True
+    )
+    assert result['status'] == 'successful'
+    assert result['frames'] == 3
+    output = Image.open(io.BytesIO(result['output_image_data']))
+    assert output.format == 'GIF' and output.n_frames == 3
+    assert output.info['duration'] == 80 and output.info['loop'] == 0
+    # One placement for the whole clip: the logo sits in the same spot on every frame
+    placement = result['placement']
+    centre = (placement['x'] + placement['width'] // 2, placement['y'] + placement['height'] // 2)
+    pixels = set()
+    for index in range(3):
+        output.seek(index)
+        pixels.add(output.convert('RGB').getpixel(centre))
+    assert pixels in ({(0, 0, 0)}, {(255, 255, 255)})
+
+@pytest.mark.parametrize('format, loop', [('GIF', 0), ('GIF', 2), ('WEBP', 0), ('WEBP', 1), ('TIFF', None)])
+def test_animation_keeps_its_container_and_loop_count(served, format, loop):
+    dark = served('/dark.png', logo_bytes(64, 32, (0, 0, 0, 255)))
+    result = app.analyzer.analyze_placement(
+        animation_bytes(format, loop=loop), dark, None, upload_to_s3=False, delete_original=False, inline=True
+    )
+    assert result['status'] == 'successful'
+    output = Image.open(io.BytesIO(result['output_image_data']))
+    assert output.format == format and output.n_frames == 3
+    if format != 'TIFF':
+        assert output.info['loop'] == loop
+        output.seek(2)
+        output.load()  # WebP reads a frame's duration with its pixels
+        assert output.info['duration'] == 80
+
+def test_logo_render_fits_the_placement_box_at_its_own_aspect_ratio(served):
+    cache = app.LogoCache()
+    tall = served('/tall.png', logo_bytes(100, 400))
+    wide = served('/wide.png', logo_bytes(400, 100))
+    # A box sized for another variant: the tall logo fits inside it rather than being stretched
+    assert cache.get_render_within(tall, 128, 32).shape[:2] == (32, 8)
+    assert cache.get_render_within(wide, 128, 32).shape[:2] == (32, 128)
+
+def test_logo_cache_counts_one_lookup_per_logo_per_request(served):
+    cache = app.analyzer.logo_cache
+    dark = served('/counted-dark.png', logo_bytes(64, 32, (0, 0, 0, 255)))
+    light = served('/counted-light.png', logo_bytes(64, 32, (255, 255, 255, 255)))
+    before = cache.stats()
+    for _ in range(2):
+        result = app.analyzer.analyze_placement(
+            image_bytes(320, 240), dark, light, upload_to_s3=False, delete_original=False, inline=True
+        )
+        assert result['status'] == 'successful'
+    after = cache.stats()
+    assert after['misses'] - before['misses'] == 2
+    assert after['hits'] - before['hits'] == 2
+
+def test_logo_render_is_fitted_down_from_a_larger_atlas_size(served, monkeypatch):
+    cache = app.LogoCache()
+    url = served('/logo.png', logo_bytes(400, 200))
+    resizes = []  # (source width, source height, interpolation)
+    resize = app.cv2.resize
+    monkeypatch.setattr(app.cv2, 'resize', lambda src, size, interpolation: resizes.append(
+        (src.shape[1], src.shape[0], interpolation)) or resize(src, size, interpolation=interpolation))
+
+    # Between the 96 and 128 atlas sizes: shrunk from 128, never grown from 96
+    assert cache.get_render_within(url, 100, 50).shape[:2] == (50, 100)
+    assert resizes == [(128, 64, app.cv2.INTER_AREA)]
+    # Past the native size there is nothing larger to start from
+    assert cache.get_render_within(url, 500, 250).shape[:2] == (250, 500)
+    assert resizes[-1] == (400, 200, app.cv2.INTER_LINEAR)
+
+@pytest.mark.parametrize('format', ['PNG', 'JPEG'])
+def test_composite_decodes_a_png_once_and_placement_only_never_keeps_full(served, monkeypatch, format):
+    decodes = []  # keep_full of each decode
+    decode = app.analyzer._decode_image
+
+    def counted(data, max_size, max_pixels, keep_full=False):
+        decodes.append(keep_full)
+        return decode(data, max_size, max_pixels, keep_full)
+
+    monkeypatch.setattr(app.analyzer, '_decode_image', counted)
+    image = image_bytes(3200, 2400, format)
+    dark = served('/dark.png', logo_bytes(64, 32, (0, 0, 0, 255)))
+    light = served('/light.png', logo_bytes(64, 32, (255, 255, 255, 255)))
+
+    result = app.analyzer.analyze_placement(image, dark, light, upload_to_s3=False, delete_original=False, inline=True)
+    assert result['status'] == 'successful'
+    # draft() shrinks JPEG decodes, so only JPEG pays for a second, full-resolution one
+    assert len(decodes) == (2 if format == 'JPEG' else 1)
+
+    decodes.clear()
+    assert app.analyzer.analyze_placement(image, dark, light, return_image=False, delete_original=False)['status'] == 'successful'
+    assert app.analyzer.analyze_placement_only(image)['status'] == 'successful'
+    assert decodes and not any(decodes)
+
+def test_spool_unknown_output_is_not_waited_for(tmp_path):
+    spool, _ = make_spool(tmp_path)
+    start = time.monotonic()
+    assert spool.path('output_missing.png') is None
+    assert time.monotonic() - start < 0.5
+
+def test_spool_works_without_metrics(tmp_path):
+    spool = app.OutputSpool(str(tmp_path / 'outputs'), ttl=60)
+    kept = write_now(spool, retry_url='s3://bucket/original.png', age=120)
+    spool.uploader = lambda encoded, s3_url: 'https://bucket/output.png'
+    spool.retry_uploads()
+    spool.sweep()
+    assert os.listdir(spool.retry_dir) == []
+    assert not os.path.exists(kept)
+
+def test_spool_releases_claims_by_age_not_pid(tmp_path):
+    spool, _ = make_spool(tmp_path, claim_timeout=60)
+    path = write_now(spool, retry_url='s3://bucket/original.png')
+    record = os.path.join(spool.retry_dir, f"{os.path.basename(path)}.json")
+    # Claimed under a live PID, as happens when a dead worker's PID is reused
+    claimed = f"{record}.{os.getpid()}"
+    os.rename(record, claimed)
+    spool.uploader = lambda encoded, s3_url: None
+
+    spool.retry_uploads()
+    assert os.listdir(spool.retry_dir) == [os.path.basename(claimed)]
+
+    stale = time.time() - 120
+    os.utime(claimed, (stale, stale))
+    spool.retry_uploads()
+    assert os.listdir(spool.retry_dir) == [os.path.basename(record)]
+
+def test_spool_drops_retry_for_empty_file(tmp_path):
+    spool, metrics = make_spool(tmp_path)
+    path = write_now(spool, retry_url='s3://bucket/original.png')
+    open(path, 'wb').close()
+    spool.uploader = lambda encoded, s3_url: 'https://bucket/output.png'
+    spool.retry_uploads()
+    assert os.listdir(spool.retry_dir) == []
+    assert spool_counter(metrics, 'dropped') == 1
+
+def load_gunicorn_conf():
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', os.path.join(os.path.dirname(app.__file__), 'gunicorn.conf.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def fork_worker(metrics, slot):
+    metrics.after_fork(slot)
+    metrics.inc('requests', 'failed')
+
+def test_metrics_sum_every_workers_slot_without_a_shared_lock():
+    metrics = app.Metrics(slots=3)
+    metrics.inc('requests', 'failed')
+    worker = multiprocessing.get_context('fork').Process(target=fork_worker, args=(metrics, 1))
+    worker.start()
+    worker.join(5)
+    assert worker.exitcode == 0
+    assert 'logo_placement_requests_total{status="failed"} 2' in metrics.render()
+    with pytest.raises(ValueError):
+        metrics.after_fork(3)
+
+def test_pre_fork_gives_each_worker_a_free_metrics_slot():
+    conf = load_gunicorn_conf()
+    server = SimpleNamespace(WORKERS={101: SimpleNamespace(metrics_slot=1), 102: SimpleNamespace(metrics_slot=3)})
+    replacement = SimpleNamespace(age=7)
+    conf.pre_fork(server, replacement)
+    assert replacement.metrics_slot == 2
+
+def test_replacement_worker_is_pinned_to_the_cores_of_the_one_it_replaces(monkeypatch):
+    conf = load_gunicorn_conf()
+    pinned = []
+    monkeypatch.setattr(conf.os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+    monkeypatch.setattr(conf.os, 'sched_setaffinity', lambda pid, cores: pinned.append(sorted(cores)), raising=False)
+    monkeypatch.setattr(conf, 'omp_thread_limit', 1)
+    server = SimpleNamespace(num_workers=4, log=SimpleNamespace(info=lambda *args: None))
+    # The worker in slot 2 died; its replacement is the fifth worker forked
+    conf.pin_worker(server, SimpleNamespace(pid=105, age=5, metrics_slot=2))
+    conf.pin_worker(server, SimpleNamespace(pid=103, age=3, metrics_slot=3))
+    assert pinned == [[2, 3], [4, 5]]
+
+def test_job_with_expired_lease_is_requeued(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'jobs.db')
+    crashed = app.JobQueue(db_path, analyzer=None, lease=60)
+    monkeypatch.setattr(crashed, 'start', lambda: None)
+    job = crashed.submit({'image_url': 'https://example.com/image.jpg'})
+    assert crashed._claim()['id'] == job['job_id']
+
+    # Another worker leaves a job alone while its lease is live
+    survivor = app.JobQueue(db_path, analyzer=None, lease=60)
+    assert survivor._claim() is None
+    assert survivor.get(job['job_id'])['status'] == 'running'
+
+    # The claiming worker dies without renewing; its lease runs out
+    with sqlite3.connect(db_path) as db:
+        db.execute('UPDATE jobs SET lease_expires = ? WHERE id = ?', (time.time() - 1, job['job_id']))
+    assert survivor._claim()['id'] == job['job_id']
+    assert survivor.get(job['job_id'])['status'] == 'running'
+
+def test_importing_the_app_creates_no_files(tmp_path):
+    app_dir = os.path.dirname(os.path.abspath(app.__file__))
+    subprocess.run([sys.executable, '-c', f"import sys; sys.path.insert(0, {app_dir!r}); import batch"], cwd=tmp_path, check=True)
+    assert os.listdir(tmp_path) == []
+
+def test_stores_create_their_database_on_first_use(tmp_path):
+    cache = app.PlacementCache(str(tmp_path / 'placements.db'))
+    jobs = app.JobQueue(str(tmp_path / 'jobs.db'), analyzer=None)
+    assert os.listdir(tmp_path) == []
+    assert cache.get('missing') is None and jobs.get('missing') is None
+    assert {'placements.db', 'jobs.db'} <= set(os.listdir(tmp_path))
+
+@pytest.fixture
+def open_connections(monkeypatch):
+    """Connections the stores open and leave unclosed"""
+    unclosed = set()
+
+    class Tracked(sqlite3.Connection):
+        def close(self):
+            unclosed.discard(self)
+            super().close()
+
+    connect = sqlite3.connect
+    def tracked(*args, **kwargs):
+        db = connect(*args, factory=Tracked, **kwargs)
+        unclosed.add(db)
+        return db
+    monkeypatch.setattr(app.sqlite3, 'connect', tracked)
+    return unclosed
+
+def test_placement_cache_closes_its_connections(tmp_path, open_connections):
+    cache = app.PlacementCache(str(tmp_path / 'placements.db'))
+    cache.put('key', [{'corner': 'top-right'}])
+    assert cache.get('key') == [{'corner': 'top-right'}]
+    assert cache.stats()['entries'] == 1
+    assert open_connections == set()
+
+def test_job_queue_closes_its_connections(tmp_path, open_connections, monkeypatch):
+    jobs = app.JobQueue(str(tmp_path / 'jobs.db'), analyzer=None)
+    monkeypatch.setattr(jobs, 'start', lambda: None)
+    job = jobs.submit({'image_url': 'https://example.com/image.jpg'})
+    assert jobs._claim()['id'] == job['job_id']
+    jobs._renew_leases()
+    jobs._finish(job['job_id'], {'status': 'successful'})
+    jobs._prune()
+    assert jobs.get(job['job_id'])['status'] == 'successful'
+    assert open_connections == set()
+
+class StopWorker(BaseException):
+    """Ends a job worker loop from a test"""
+
+def test_job_worker_survives_a_database_error_and_releases_the_job(tmp_path, monkeypatch):
+    processed = []
+    analyzer = SimpleNamespace(process_image=lambda image_url, *args: processed.append(image_url) or {'status': 'successful'})
+    jobs = app.JobQueue(str(tmp_path / 'jobs.db'), analyzer, lease=1)
+    monkeypatch.setattr(jobs, 'start', lambda: None)
+    first = jobs.submit({'image_url': 'https://example.com/first.jpg'})
+    second = jobs.submit({'image_url': 'https://example.com/second.jpg'})
+
+    finish = jobs._finish
+    outcomes = iter([sqlite3.OperationalError('database is locked'), None, StopWorker()])
+
+    def flaky_finish(job_id, result):
+        outcome = next(outcomes)
+        if outcome is not None:
+            raise outcome
+        finish(job_id, result)
+
+    monkeypatch.setattr(jobs, '_finish', flaky_finish)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    with pytest.raises(StopWorker):
+        jobs._work()
+
+    # The worker carried on to the next job, and stopped renewing the failed one, whose lease lapsed
+    assert processed == ['https://example.com/first.jpg', 'https://example.com/second.jpg', 'https://example.com/first.jpg']
+    assert jobs.get(second['job_id'])['status'] == 'successful'
+    assert jobs._running == set()
+
+def test_outputs_are_served_whatever_the_working_directory(tmp_path, monkeypatch):
+    assert app.analyzer.spool.directory == os.path.join(app.APP_DIR, 'outputs')
+    monkeypatch.chdir(tmp_path)
+    spool = app.OutputSpool('outputs', metrics=app.Metrics())
+    monkeypatch.setattr(app.analyzer, 'spool', spool)
+    path = write_now(spool)
+    assert path == str(tmp_path / 'outputs' / os.path.basename(path))
+
+    monkeypatch.chdir(app.APP_DIR)
+    response = app.app.test_client().get(f"/outputs/{os.path.basename(path)}")
+    assert response.status_code == 200
+    assert response.data == b'x' * 100